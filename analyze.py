@@ -0,0 +1,200 @@
+#!/usr/local/bin/python3
+
+"""
+Batch analysis of Gobblet positions, for scoring large sets of positions from
+game archives or puzzle sets.
+
+Positions are read from a text file, one per line, as written by
+Gobblet.position_string (board, stacks and side to move), for example:
+
+  X4,.,.,./.,X3,.,./.,.,X2,./O4,O3,O2,. 441/441 X
+
+Blank lines and lines starting with "#" are skipped. The file is streamed, so
+it can be far larger than memory, and the positions are searched across a pool
+of worker processes, each with its own search budget. One JSON line is written
+per position as soon as it is analyzed, in completion order:
+
+  { "line": 3, "position": "...", "move": "4DD", "score": 9999999,
+    "depth": 1, "nodes": 17, "seconds": 0.01, "source": "search" }
+
+where line is the line number in the input file, move is in the same XY
+notation as the prompts of ./gobblet.py (null if the side to move has no
+legal move), and score is from the side to move's point of view. A position
+that cannot be read gets { "line": ..., "position": ..., "error": "..." }
+instead.
+
+Each result is flushed as it is written, so an interrupted run loses only the
+positions being searched at the time. Run the same command again to resume:
+the lines already in the output file are skipped, and a last line cut short
+by the interruption is dropped. Each position is searched with an empty
+transposition table and a random seed of the base seed plus its line number,
+so a resumed run gives the same results as an uninterrupted one, within the
+limits of a time budget.
+
+Usage:
+
+  ./analyze.py positions.txt --output analysis.jsonl --think-ms 1000 --workers 8
+  ./analyze.py positions.txt --output analysis.jsonl --depth 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from gobblet import Gobblet, flip_notation, load_weights
+from pns import ProofNumberSearch
+
+# Each worker process keeps one Gobblet for all the positions it analyzes
+analysis_worker = None
+
+def init_analysis_worker(board_size, num_sizes, num_stacks, tt_mb, think_ms, depth, pns_nodes,
+                         weights_path):
+    global analysis_worker
+    pns = ProofNumberSearch(pns_nodes) if pns_nodes else None
+    weights = (load_weights(weights_path, board_size, num_sizes, num_stacks) if weights_path
+               else None)
+    analysis_worker = Gobblet(tt_mb=tt_mb, board_size=board_size, num_sizes=num_sizes,
+                              num_stacks=num_stacks, pns=pns, weights=weights)
+    # A depth limit alone searches to that depth, however long it takes
+    analysis_worker.think_ms = think_ms if think_ms else float("inf")
+    analysis_worker.max_depth = depth or 32
+
+def analyze_position(task):
+    # Search one position in a worker process and return its result dict
+    line_number, position, seed = task
+    gobblet = analysis_worker
+    result = { "line": line_number, "position": position }
+    try:
+        board, stacks, player = gobblet.parse_position(position)
+    except ValueError as error:
+        result["error"] = str(error)
+        return result
+    gobblet.set_position(board, stacks)
+    gobblet.reset_history(player)
+    gobblet.tt.clear()
+    gobblet.random.seed(seed)
+    move = gobblet.choose_move(player)
+    stats = gobblet.stats
+    result["move"] = flip_notation(move[0]) + flip_notation(move[1]) if move else None
+    result["score"] = move[2] if move else None
+    result["depth"] = stats["depth"]
+    result["nodes"] = stats["nodes"]
+    result["seconds"] = round(stats["seconds"], 3)
+    result["source"] = stats["source"]
+    return result
+
+def read_done(path):
+    # Return the line numbers already analyzed in the output file 'path', if
+    # it exists, after cutting off a last line left incomplete by an
+    # interrupted run
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as file:
+        data = file.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            file.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            done.add(json.loads(line)["line"])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return done
+
+def read_positions(path, done, seed):
+    # Generator of (line number, position, seed) tasks for the positions of
+    # the input file not yet analyzed
+    with open(path) as file:
+        for line_number, line in enumerate(file, 1):
+            position = line.strip()
+            if not position or position.startswith("#") or line_number in done:
+                continue
+            yield line_number, position, seed + line_number
+
+def run_analysis(tasks, workers=None, board_size=4, num_sizes=4, num_stacks=3, tt_mb=16,
+                 think_ms=1000, depth=None, pns_nodes=None, weights_path=None):
+    # Generator yielding the result of each task as it finishes, in
+    # completion order. workers=1 analyzes the positions in this process.
+    init_args = (board_size, num_sizes, num_stacks, tt_mb, think_ms, depth, pns_nodes,
+                 weights_path)
+    if workers == 1:
+        init_analysis_worker(*init_args)
+        for task in tasks:
+            yield analyze_position(task)
+        return
+
+    workers = workers or os.cpu_count()
+    # The pool reads tasks as fast as it can, so only let a few of them be
+    # handed out ahead of the results, to keep memory flat on large files
+    slots = threading.BoundedSemaphore(4 * workers)
+
+    def limited(tasks):
+        for task in tasks:
+            slots.acquire()
+            yield task
+
+    with multiprocessing.Pool(workers, init_analysis_worker, init_args) as pool:
+        for result in pool.imap_unordered(analyze_position, limited(tasks)):
+            slots.release()
+            yield result
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze Gobblet positions from a file")
+    parser.add_argument("positions", help="file of positions, one per line")
+    parser.add_argument("--output", default=None,
+                        help="file to append JSON lines to, resuming if it has results "
+                             "(default: stdout)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--think-ms", type=int, default=None,
+                        help="search time per position (default: 1000, or none with --depth)")
+    parser.add_argument("--depth", type=int, default=None, help="search depth limit per position")
+    parser.add_argument("--pns-nodes", type=int, default=None,
+                        help="look for forced wins in sharp positions with proof-number "
+                             "search of this many nodes")
+    parser.add_argument("--weights", default=None,
+                        help="evaluation weights file written by tune.py")
+    parser.add_argument("--tt-mb", type=int, default=16,
+                        help="transposition table size per worker in MB")
+    parser.add_argument("--seed", type=int, default=0, help="base random seed")
+    parser.add_argument("--size", type=int, default=4, help="board size")
+    parser.add_argument("--sizes", type=int, default=4, help="number of piece sizes")
+    parser.add_argument("--stacks", type=int, default=3, help="number of stacks per player")
+    args = parser.parse_args()
+
+    if args.weights:
+        try:
+            load_weights(args.weights, args.size, args.sizes, args.stacks)
+        except ValueError as error:
+            parser.error(str(error))
+
+    think_ms = args.think_ms
+    if think_ms is None and args.depth is None:
+        think_ms = 1000
+    done = read_done(args.output) if args.output else set()
+    tasks = read_positions(args.positions, done, args.seed)
+    results = run_analysis(tasks, args.workers, args.size, args.sizes, args.stacks, args.tt_mb,
+                           think_ms, args.depth, args.pns_nodes, args.weights)
+
+    start = time.perf_counter()
+    count = 0
+    out = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        seconds = time.perf_counter() - start
+        print(f"analyzed {count} positions in {seconds:.1f}s, skipped {len(done)} already done",
+              file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#!/usr/local/bin/python3
+
+"""
+Benchmark and regression suite for the Gobblet move generator, evaluation
+and search.
+
+A fixed set of reference positions, each given by the moves that lead to it
+from the start, is used for:
+
+  perft:   the number of move sequences of exactly N moves from the position,
+           found with get_legal_moves, make_move, undo_move and is_a_winner,
+           and checked against known counts. A move that wins ends the game,
+           so it only counts as a leaf at the last move.
+  movegen: get_legal_moves calls per second
+  eval:    evaluate_board calls per second
+  search:  nodes per second of a fixed-depth search_move
+  parallel: speedup of parallel_search_move with --workers processes over
+           search_move in one process, searching to the same fixed depth
+           (the time of one process over the time of the workers)
+  batch:   positions per second of evaluate_batch over every position two
+           moves on, checked against evaluate_board with noise turned off, as
+           the batch evaluator has none (needs NumPy)
+
+All random scores come from a Gobblet seeded with --seed, so every count,
+including the node counts and best moves of the searches, is the same from
+one run to the next. The results are written as one JSON object, for
+comparing runs across commits. With --check, the exit status is 1 if any
+perft count differs from the known one, or a batch score from evaluate_board's.
+With --weights, the positions of the variant of a weights file written by
+tune.py are scored with the parameterized evaluation instead.
+
+Usage:
+
+  ./bench.py --perft-depth 3 --seed 1 --output bench.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from gobblet import Gobblet
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Name, variant (board size, number of sizes, number of stacks) and the moves
+# leading to each position, in internal notation, with player 1 moving first
+REFERENCE_POSITIONS = [
+    ("start", (4, 4, 3), []),
+    ("opening", (4, 4, 3), [ ("4", "AB"), ("4", "CA"), ("3", "AC"), ("3", "DA") ]),
+    ("midgame", (4, 4, 3), [ ("4", "AB"), ("4", "CA"), ("3", "AC"), ("3", "DA"), ("2", "AA"),
+                             ("4", "AA"), ("AB", "DA"), ("AA", "CD") ]),
+    ("crowded", (4, 4, 3), [ ("4", "AB"), ("4", "BD"), ("AB", "BA"), ("BD", "DA"), ("4", "DD"),
+                             ("4", "CD"), ("DD", "CB"), ("CD", "AB"), ("BA", "AC"), ("AB", "AA"),
+                             ("3", "CD"), ("3", "BA"), ("2", "CA") ]),
+    ("gobblers", (3, 3, 2), []),
+    ("gobblers-midgame", (3, 3, 2), [ ("3", "BB"), ("3", "AA"), ("2", "AC"), ("2", "CA"),
+                                      ("BB", "CC") ]),
+]
+
+# Known perft counts of each reference position, from depth 1 up
+PERFT_COUNTS = {
+    "start": [ 16, 240, 10080, 409920 ],
+    "opening": [ 52, 2619, 149565 ],
+    "midgame": [ 60, 3780, 222113 ],
+    "crowded": [ 65, 4499, 269303 ],
+    "gobblers": [ 9, 72, 1512, 29736 ],
+    "gobblers-midgame": [ 24, 497, 10277, 202429 ],
+}
+
+def reference_position(name, variant, moves, seed=None, weights=None):
+    # Return a Gobblet set up at a reference position, and the player to move
+    board_size, num_sizes, num_stacks = variant
+    gobblet = Gobblet(board_size=board_size, num_sizes=num_sizes, num_stacks=num_stacks,
+                      seed=seed)
+    # Weights are tuned for one variant, so the others keep the original
+    # evaluation
+    if weights and variant == tuple(weights["variant"]):
+        gobblet.set_weights(weights["weights"])
+    player = 1
+    for move, dest in moves:
+        gobblet.make_move(player, move, dest)
+        if gobblet.is_a_winner(player):
+            raise ValueError(f"reference position {name} is a finished game")
+        player = 3 - player
+    return gobblet, player
+
+def perft(gobblet, player, depth):
+    # Count the move sequences of exactly 'depth' moves from the position
+    if depth == 0:
+        return 1
+    count = 0
+    for move, dest, _ in gobblet.get_legal_moves(player):
+        if depth == 1:
+            count += 1
+            continue
+        undo = gobblet.make_move(player, move, dest)
+        if not gobblet.is_a_winner(player):
+            count += perft(gobblet, 3 - player, depth - 1)
+        gobblet.undo_move(undo)
+    return count
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def bench_perft(positions, max_depth):
+    results = []
+    for name, gobblet, player in positions:
+        known = PERFT_COUNTS.get(name, [])
+        for depth in range(1, max_depth + 1):
+            count, seconds = timed(perft, gobblet, player, depth)
+            expected = known[depth - 1] if depth <= len(known) else None
+            results.append({
+                "position": name,
+                "depth": depth,
+                "nodes": count,
+                "expected": expected,
+                "ok": expected is None or count == expected,
+                "seconds": seconds,
+                "nodes_per_second": count / seconds if seconds else None,
+            })
+    return results
+
+def bench_calls(positions, iterations, call):
+    # Time 'iterations' calls of call(gobblet, player) at each position
+    results = []
+    for name, gobblet, player in positions:
+        def run():
+            for _ in range(iterations):
+                call(gobblet, player)
+        _, seconds = timed(run)
+        results.append({
+            "position": name,
+            "calls": iterations,
+            "seconds": seconds,
+            "calls_per_second": iterations / seconds if seconds else None,
+        })
+    return results
+
+def bench_search(positions, depth):
+    results = []
+    for name, gobblet, player in positions:
+        # Fixed depth rather than a time limit, so the node counts are the same
+        # on any machine
+        gobblet.think_ms = 3600 * 1000
+        gobblet.max_depth = depth
+        gobblet.tt.clear()
+        best, seconds = timed(gobblet.search_move, player)
+        results.append({
+            "position": name,
+            "depth": gobblet.search_depth,
+            "nodes": gobblet.nodes,
+            "best": best,
+            "seconds": seconds,
+            "nodes_per_second": gobblet.nodes / seconds if seconds else None,
+        })
+    return results
+
+def bench_parallel(serial_positions, parallel_positions, depth, workers):
+    # Search each position to the same depth in this process and with the
+    # root moves split between 'workers' processes, which start with a
+    # depth 1 search so that their start-up is not timed
+    results = []
+    for (name, serial, player), (_, parallel, _) in zip(serial_positions, parallel_positions):
+        serial.think_ms = parallel.think_ms = 3600 * 1000
+        serial.max_depth = depth
+        serial.tt.clear()
+        _, serial_seconds = timed(serial.search_move, player)
+        parallel.workers = workers
+        parallel.max_depth = 1
+        parallel.parallel_search_move(player)
+        parallel.max_depth = depth
+        _, parallel_seconds = timed(parallel.parallel_search_move, player)
+        parallel.close()
+        results.append({
+            "position": name,
+            "depth": depth,
+            "workers": workers,
+            "serial_seconds": serial_seconds,
+            "parallel_seconds": parallel_seconds,
+            "speedup": serial_seconds / parallel_seconds if parallel_seconds else None,
+            "utilization": parallel.parallel_stats["utilization"],
+        })
+    return results
+
+def bench_batch(positions):
+    results = []
+    for name, gobblet, player in positions:
+        # Bitboards of every unfinished position two moves on, with the
+        # scores evaluate_board gives them with noise off, as evaluate_batch
+        # has none
+        gobblet.noise = False
+        rows = []
+        scores = []
+        for move, dest, _ in gobblet.get_legal_moves(player):
+            undo = gobblet.make_move(player, move, dest)
+            if not gobblet.is_a_winner(player):
+                for reply, reply_dest, _ in gobblet.get_legal_moves(3 - player):
+                    reply_undo = gobblet.make_move(3 - player, reply, reply_dest)
+                    if not gobblet.is_a_winner(3 - player):
+                        rows.append(gobblet.pieces[0] + gobblet.pieces[1])
+                        scores.append(gobblet.evaluate_board(3 - player))
+                    gobblet.undo_move(reply_undo)
+            gobblet.undo_move(undo)
+        encoded = numpy.array(rows, dtype=numpy.uint64).reshape(len(rows), 2 * gobblet.num_sizes)
+        batch_scores, seconds = timed(gobblet.evaluate_batch, 3 - player, encoded)
+        gobblet.noise = True
+        results.append({
+            "position": name,
+            "positions": len(rows),
+            "ok": batch_scores == scores,
+            "seconds": seconds,
+            "positions_per_second": len(rows) / seconds if seconds else None,
+        })
+    return results
+
+def run_benchmarks(seed=0, perft_depth=3, iterations=2000, search_depth=3, weights=None,
+                   workers=2):
+    # Run every benchmark on fresh copies of the reference positions and
+    # return the results as a dict
+    def positions():
+        # Every benchmark gets freshly seeded positions, so each one's results
+        # do not depend on which others were run
+        return [ (name, *reference_position(name, variant, moves, seed, weights))
+                 for name, variant, moves in REFERENCE_POSITIONS ]
+
+    return {
+        "seed": seed,
+        "python": platform.python_version(),
+        "perft": bench_perft(positions(), perft_depth),
+        "movegen": bench_calls(positions(), iterations,
+                               lambda gobblet, player: gobblet.get_legal_moves(player)),
+        "eval": bench_calls(positions(), iterations,
+                            lambda gobblet, player: gobblet.evaluate_board(player)),
+        "search": bench_search(positions(), search_depth),
+        "parallel": (bench_parallel(positions(), positions(), search_depth, workers)
+                     if workers > 1 else None),
+        "batch": bench_batch(positions()) if numpy is not None else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Gobblet engine")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random scores")
+    parser.add_argument("--perft-depth", type=int, default=3, help="deepest perft to run")
+    parser.add_argument("--iterations", type=int, default=2000,
+                        help="calls per position for the movegen and eval benchmarks")
+    parser.add_argument("--search-depth", type=int, default=3, help="depth of the searches")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="processes for the parallel search benchmark (1 to skip it)")
+    parser.add_argument("--weights", default=None,
+                        help="evaluation weights file written by tune.py, used for the "
+                             "positions of its variant")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with status 1 if a perft count is wrong or a batch "
+                             "score differs from evaluate_board's")
+    parser.add_argument("--output", default=None,
+                        help="file to write the JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    weights = None
+    if args.weights:
+        with open(args.weights) as file:
+            weights = json.load(file)
+    results = run_benchmarks(args.seed, args.perft_depth, args.iterations, args.search_depth,
+                             weights, args.workers)
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        json.dump(results, out, indent=2)
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    failures = [ result for result in results["perft"] if not result["ok"] ]
+    for result in failures:
+        print(f"perft {result['position']} depth {result['depth']}: {result['nodes']} nodes, "
+              f"expected {result['expected']}", file=sys.stderr)
+    for result in results["batch"] or []:
+        if not result["ok"]:
+            failures.append(result)
+            print(f"batch {result['position']}: scores differ from evaluate_board", file=sys.stderr)
+    if args.check and failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
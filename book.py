@@ -0,0 +1,162 @@
+#!/usr/local/bin/python3
+
+"""
+Opening book for the Gobblet computer player.
+
+The book is built offline by searching every position up to a given number
+of moves from the start, and is written as a binary file of fixed-size
+records sorted by position key, so that it can be searched in place through
+mmap without loading it. Many engine processes can then share one book
+through the page cache.
+
+Positions are keyed by the canonical hash of the board (see
+Gobblet.canonical_hash) combined with the side to move, so all 8 symmetric
+images of a position share one record, and the stored move is the best move
+on the canonical board.
+
+File layout (little-endian):
+
+  header:  8-byte magic "GOBBOOK1", 4-byte record count
+  records: 8-byte key, 1-byte move source, 1-byte destination square,
+           1-byte search depth, 1 pad byte, 4-byte score
+
+Books cover the standard 4x4 game only. Move sources and destinations use the
+numbering of Geometry.encode_source and the bitboard square indexes.
+
+Usage:
+
+  ./book.py --depth 3 --think-ms 2000 --workers 8 --output book.bin
+"""
+
+import argparse
+import copy
+import mmap
+import multiprocessing
+import struct
+
+from gobblet import Gobblet, get_geometry
+
+BOOK_MAGIC = b"GOBBOOK1"
+HEADER = struct.Struct("<8sI")
+RECORD = struct.Struct("<QBBBxi")
+KEY = struct.Struct("<Q")
+
+# Books are only built for the standard board
+geo = get_geometry()
+
+class OpeningBook:
+    # Read-only view of a book file through mmap
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != BOOK_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a Gobblet opening book")
+
+    def lookup(self, key):
+        # Binary search for 'key' and return (move, dest, score) in internal
+        # notation on the canonical board, or None if it is not in the book
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            middle_key = KEY.unpack_from(self.data, offset)[0]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                _, source, dest, _, score = RECORD.unpack_from(self.data, offset)
+                return geo.decode_source(source), geo.square_names[dest], score
+        return None
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+# Books opened by open_book, one per path in each process
+open_books = {}
+
+def open_book(path):
+    # Open a book once per process and share it between Gobblet instances
+    if path not in open_books:
+        open_books[path] = OpeningBook(path)
+    return open_books[path]
+
+def position_key(gobblet, player):
+    hash, sym = gobblet.canonical_hash()
+    return hash ^ geo.side_keys[player - 1], sym
+
+def search_position(task):
+    # Find the best move of one book position, in canonical notation
+    board, stacks, player, think_ms = task
+    gobblet = Gobblet(think_ms=think_ms)
+    gobblet.set_position(board, stacks)
+    key, sym = position_key(gobblet, player)
+    # Seed from the position, so the same book is built every time
+    gobblet.random.seed(key)
+    move, dest, score = gobblet.search_move(player)
+    move, dest = geo.transform_move(sym, move, dest)
+    return key, move, dest, gobblet.search_depth, score
+
+def expand_positions(positions, seen):
+    # Return the positions one move on from 'positions' that have not been
+    # seen yet, leaving out finished games
+    children = []
+    for board, stacks, player in positions:
+        gobblet = Gobblet()
+        gobblet.set_position(board, stacks)
+        for move, dest, _ in gobblet.get_legal_moves(player, unique=True):
+            undo = gobblet.make_move(player, move, dest)
+            if not gobblet.is_a_winner(player):
+                key, _ = position_key(gobblet, 3 - player)
+                if key not in seen:
+                    seen.add(key)
+                    children.append((copy.deepcopy(gobblet.board),
+                                     copy.deepcopy(gobblet.player_stacks), 3 - player))
+            gobblet.undo_move(undo)
+    return children
+
+def build_book(depth, think_ms, workers=None):
+    # Search every position reached in fewer than 'depth' moves from the
+    # start and return the sorted list of records
+    start = Gobblet()
+    positions = [ (start.board, start.player_stacks, 1) ]
+    seen = { position_key(start, 1)[0] }
+    records = []
+    with multiprocessing.Pool(workers) as pool:
+        for ply in range(depth):
+            tasks = [ (board, stacks, player, think_ms) for board, stacks, player in positions ]
+            records.extend(pool.map(search_position, tasks))
+            if ply + 1 < depth:
+                positions = expand_positions(positions, seen)
+    records.sort()
+    return records
+
+def write_book(path, records):
+    with open(path, "wb") as book_file:
+        book_file.write(HEADER.pack(BOOK_MAGIC, len(records)))
+        for key, move, dest, depth, score in records:
+            book_file.write(RECORD.pack(key, geo.encode_source(move), geo.square_index[dest],
+                                        min(depth, 255), score))
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a Gobblet opening book")
+    parser.add_argument("--depth", type=int, default=2,
+                        help="number of moves from the start to cover")
+    parser.add_argument("--think-ms", type=int, default=1000,
+                        help="search time per book position")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--output", default="book.bin", help="book file to write")
+    args = parser.parse_args()
+
+    records = build_book(args.depth, args.think_ms, args.workers)
+    write_book(args.output, records)
+    print(f"Wrote {len(records)} positions to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+#!/usr/local/bin/python3
+
+"""
+Long-lived Gobblet engine speaking a UCI-like text protocol on stdin/stdout,
+for tournament managers and GUIs.
+
+One Gobblet is kept for the whole session, so its transposition table stays
+warm from one move to the next, and the engine can ponder: search the
+position after its expected reply on the opponent's time, and carry on from
+there if the opponent plays that reply.
+
+Moves are written as the source followed by the destination, in the same XY
+notation as the prompts of ./gobblet.py (column letter first, then row
+letter): "4BA" adds a new size 4 piece on BA, "BACB" moves the piece on BA to
+CB. Positions are written as by Gobblet.position_string.
+
+Commands:
+
+  gei                      reply with the engine's id and options, then geiok
+  isready                  reply readyok
+  setoption name <name> value <value>
+                           Hash (transposition table MB), BoardSize, Sizes,
+                           Stacks (the variant; changing it starts a new game)
+  newgame                  forget everything learned in the last game
+  position startpos [moves <move> ...]
+  position pos <board> <stacks> <side> [moves <move> ...]
+                           set up the position to search
+  go [movetime <ms>] [depth <n>] [wtime <ms>] [btime <ms>] [winc <ms>]
+     [binc <ms>] [infinite] [ponder]
+                           search the position, answering with info lines
+                           after each completed depth, then bestmove. With
+                           infinite or ponder, the search carries on until
+                           stop, or ponderhit for ponder.
+  ponderhit                the opponent played the expected move: the ponder
+                           search becomes a normal search with the go limits
+  stop                     end the search and answer with bestmove at once
+  quit
+
+Answers:
+
+  info depth <n> score cp <score> nodes <n> time <ms> nps <n> pv <move> ...
+  info depth <n> score mate <plies> ...   (negative plies for a loss)
+  bestmove <move> [ponder <move>]         (bestmove none with no legal move)
+
+Usage:
+
+  ./engine.py
+"""
+
+import sys
+import threading
+import time
+
+from gobblet import Gobblet, TranspositionTable, flip_notation
+
+class Engine:
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.output_lock = threading.Lock()
+        self.tt_mb = 16
+        self.variant = (4, 4, 3)
+        self.new_gobblet()
+        self.thread = None
+        self.search_limit_ms = None
+        self.pondering = False
+        # Searches with no time limit hold their bestmove until this is set
+        # by stop or ponderhit
+        self.release = threading.Event()
+        self.hit_deadline = None
+
+    def new_gobblet(self):
+        board_size, num_sizes, num_stacks = self.variant
+        self.gobblet = Gobblet(tt_mb=self.tt_mb, board_size=board_size, num_sizes=num_sizes,
+                               num_stacks=num_stacks)
+        self.gobblet.depth_callback = self.report_depth
+        self.start = self.gobblet.position_string(1)
+        self.position = self.start
+        self.history = {}
+        self.quiet_moves = 0
+        self.player = 1
+
+    def send(self, line):
+        with self.output_lock:
+            self.out.write(line + "\n")
+            self.out.flush()
+
+    def format_move(self, move, dest):
+        return flip_notation(move) + flip_notation(dest)
+
+    def parse_move(self, text):
+        # Read a move such as "4BA" or "BACB" into internal notation
+        text = text.upper()
+        if len(text) == 3:
+            return text[0], flip_notation(text[1:])
+        if len(text) == 4:
+            return flip_notation(text[:2]), flip_notation(text[2:])
+        raise ValueError(f"bad move {text!r}")
+
+    def handle(self, line):
+        # Carry out one command. Returns False for quit.
+        words = line.split()
+        if not words:
+            return True
+        command, args = words[0], words[1:]
+        if command == "gei":
+            board_size, num_sizes, num_stacks = self.variant
+            self.send("id name Gobblet")
+            self.send(f"option name Hash type spin default {self.tt_mb} min 0 max 4096")
+            self.send(f"option name BoardSize type spin default {board_size} min 3 max 8")
+            self.send(f"option name Sizes type spin default {num_sizes} min 1 max 4")
+            self.send(f"option name Stacks type spin default {num_stacks} min 1 max 8")
+            self.send("geiok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "setoption":
+            self.stop_search()
+            self.set_option(args)
+        elif command == "newgame":
+            self.stop_search()
+            self.gobblet.tt.clear()
+        elif command == "position":
+            self.stop_search()
+            self.set_position(args)
+        elif command == "go":
+            self.stop_search()
+            self.go(args)
+        elif command == "ponderhit":
+            self.ponder_hit()
+        elif command == "stop":
+            self.stop_search()
+        elif command == "quit":
+            self.stop_search()
+            return False
+        else:
+            self.send(f"info string unknown command {command}")
+        return True
+
+    def set_option(self, args):
+        if "name" not in args or "value" not in args:
+            self.send("info string setoption needs a name and a value")
+            return
+        name = " ".join(args[args.index("name") + 1:args.index("value")])
+        value = " ".join(args[args.index("value") + 1:])
+        try:
+            if name == "Hash":
+                self.tt_mb = int(value)
+                self.gobblet.tt = TranspositionTable(self.tt_mb)
+                self.gobblet.tt_mb = self.tt_mb
+            elif name in ("BoardSize", "Sizes", "Stacks"):
+                board_size, num_sizes, num_stacks = self.variant
+                if name == "BoardSize":
+                    board_size = int(value)
+                elif name == "Sizes":
+                    num_sizes = int(value)
+                else:
+                    num_stacks = int(value)
+                old_variant = self.variant
+                self.variant = (board_size, num_sizes, num_stacks)
+                try:
+                    self.new_gobblet()
+                except ValueError:
+                    self.variant = old_variant
+                    raise
+            else:
+                self.send(f"info string unknown option {name}")
+        except ValueError as error:
+            self.send(f"info string bad value for {name}: {error}")
+
+    def set_position(self, args):
+        # Set up the position, leaving the engine's position as it was if any
+        # part of the command is not valid
+        gobblet = self.gobblet
+        if "moves" in args:
+            moves = args[args.index("moves") + 1:]
+            args = args[:args.index("moves")]
+        else:
+            moves = []
+        try:
+            if args == [ "startpos" ]:
+                position = self.start
+            elif args[:1] == [ "pos" ]:
+                position = " ".join(args[1:])
+            else:
+                raise ValueError("expected startpos or pos")
+            board, stacks, player = gobblet.parse_position(position)
+            gobblet.set_position(board, stacks)
+            # The moves are the game history, so the search can steer clear
+            # of repeating its positions
+            gobblet.reset_history(player)
+            for text in moves:
+                move, dest = self.parse_move(text)
+                if (move not in gobblet.geo.slot_sizes and move not in gobblet.geo.square_index
+                        or dest not in gobblet.geo.square_index
+                        or not gobblet.is_legal_move(player, move, dest)):
+                    raise ValueError(f"illegal move {text}")
+                gobblet.make_move(player, move, dest)
+                gobblet.record_move(player, move)
+                player = 3 - player
+        except ValueError as error:
+            self.send(f"info string {error}")
+            board, stacks, player = gobblet.parse_position(self.position)
+            gobblet.set_position(board, stacks)
+            gobblet.position_counts = self.history
+            gobblet.quiet_moves = self.quiet_moves
+        self.player = player
+        self.position = gobblet.position_string(player)
+        self.history = gobblet.position_counts
+        self.quiet_moves = gobblet.quiet_moves
+
+    def go(self, args):
+        # Work out the limits of the search and start it in the background
+        limits = {}
+        flags = set()
+        i = 0
+        while i < len(args):
+            if args[i] in ("infinite", "ponder"):
+                flags.add(args[i])
+                i += 1
+            elif i + 1 < len(args):
+                try:
+                    limits[args[i]] = int(args[i + 1])
+                except ValueError:
+                    self.send(f"info string bad value for {args[i]}")
+                i += 2
+            else:
+                i += 1
+
+        # Search for movetime, or else a share of the remaining clock time
+        # for the side to move, or else without a time limit
+        think_ms = limits.get("movetime")
+        clock = limits.get("wtime" if self.player == 1 else "btime")
+        if think_ms is None and clock is not None:
+            increment = limits.get("winc" if self.player == 1 else "binc", 0)
+            think_ms = max(1, min(clock // 20 + increment // 2, clock - 50))
+        if think_ms is None and "depth" not in limits:
+            flags.add("infinite")
+        self.search_limit_ms = think_ms
+        self.pondering = "ponder" in flags
+        self.hit_deadline = None
+        self.release.clear()
+        gobblet = self.gobblet
+        gobblet.max_depth = limits.get("depth", 32)
+        # An infinite or ponder search runs until stop or ponderhit, and a
+        # search limited only by depth until it completes that depth
+        if flags & { "infinite", "ponder" }:
+            gobblet.think_ms = float("inf")
+        else:
+            gobblet.think_ms = think_ms if think_ms is not None else float("inf")
+            self.release.set()
+        self.search_start = time.perf_counter()
+        self.thread = threading.Thread(target=self.search, daemon=True)
+        self.thread.start()
+
+    def search(self):
+        gobblet = self.gobblet
+        player = self.player
+        best = gobblet.search_move(player)
+        gobblet.max_depth = 32
+        self.release.wait()
+        if best is None:
+            self.send("bestmove none")
+            return
+        line = f"bestmove {self.format_move(best[0], best[1])}"
+        pv = self.principal_variation(player, best, 2)
+        if len(pv) > 1:
+            line += f" ponder {pv[1]}"
+        self.send(line)
+
+    def report_depth(self, depth, best):
+        # Called by search_move after each completed depth
+        gobblet = self.gobblet
+        # A ponderhit that came just as the search started may have had its
+        # deadline overwritten by search_move
+        if self.hit_deadline is not None and gobblet.deadline > self.hit_deadline:
+            gobblet.deadline = self.hit_deadline
+        ms = int(1000 * (time.perf_counter() - self.search_start))
+        score = best[2]
+        if abs(score) > gobblet.huge_score:
+            plies = gobblet.win_score - abs(score)
+            score_text = f"mate {plies if score > 0 else -plies}"
+        else:
+            score_text = f"cp {score}"
+        pv = self.principal_variation(self.player, best, depth)
+        self.send(f"info depth {depth} score {score_text} nodes {gobblet.nodes} time {ms} "
+                  f"nps {int(1000 * gobblet.nodes / ms) if ms else 0} pv {' '.join(pv)}")
+
+    def principal_variation(self, player, best, depth):
+        # Follow the best moves stored in the transposition table from the
+        # root move 'best', for up to 'depth' moves, leaving the board as it was
+        gobblet = self.gobblet
+        pv = []
+        undos = []
+        move, dest = best[0], best[1]
+        while len(pv) < depth:
+            pv.append(self.format_move(move, dest))
+            undos.append(gobblet.make_move(player, move, dest))
+            if gobblet.is_a_winner(player):
+                break
+            player = 3 - player
+            entry = gobblet.tt.probe(gobblet.hash ^ gobblet.geo.side_keys[player - 1])
+            if not entry or not entry[4] or not gobblet.is_legal_move(player, *entry[4]):
+                break
+            move, dest = entry[4]
+        for undo in reversed(undos):
+            gobblet.undo_move(undo)
+        return pv
+
+    def ponder_hit(self):
+        # The ponder search carries on as a normal search, with the time
+        # limit of the go command counted from now
+        if self.thread is None or not self.pondering:
+            return
+        self.pondering = False
+        if self.search_limit_ms is not None:
+            self.hit_deadline = time.perf_counter() + self.search_limit_ms / 1000
+            self.gobblet.think_ms = self.search_limit_ms
+            self.gobblet.deadline = self.hit_deadline
+        self.release.set()
+
+    def stop_search(self):
+        # End the search, if any, and wait for its bestmove. Depth 1 always
+        # completes, so that there is a move to give.
+        if self.thread is None:
+            return
+        self.release.set()
+        # search_move sets its own deadline as it starts, so keep ending it
+        # until the search thread is done
+        while self.thread.is_alive():
+            self.gobblet.deadline = 0
+            self.thread.join(0.01)
+        self.thread = None
+        self.pondering = False
+
+    def run(self, lines):
+        for line in lines:
+            if not self.handle(line):
+                break
+        self.stop_search()
+
+def main():
+    engine = Engine()
+    engine.run(sys.stdin)
+
+if __name__ == "__main__":
+    main()
@@ -83,30 +83,541 @@ How is a move validated?
    less than the piece being moved
 """
 
+import itertools
+import json
+import multiprocessing
 import random
-import copy
+import time
 from operator import itemgetter
 
+# NumPy is optional. Without it, positions are always evaluated one at a time.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Square indexes of the set bits of every possible byte, used to turn a mask
+# into a list of squares without testing each bit in turn
+BYTE_SQUARES = [ [ bit for bit in range(8) if byte & (1 << bit) ] for byte in range(256) ]
+
+class Geometry:
+    # Lookup tables for one variant of the game: the board size, number of
+    # piece sizes and number of stacks per player. Tables are shared by all
+    # games of the same variant through get_geometry.
+    #
+    # Bitboard layout: each square is one bit of a mask, with bit
+    # (row * size + column) standing for board[row][column]. Square names use
+    # the same internal row/column letter order as do_move, e.g. "AB" is row A,
+    # column B. Slot 0 of a square holds the largest piece size.
+
+    def __init__(self, size, num_sizes, num_stacks):
+        if size < 3 or size > 8:
+            raise ValueError("board size must be 3-8")
+        if num_sizes < 1 or num_sizes > 4:
+            raise ValueError("number of piece sizes must be 1-4")
+        if num_stacks < 1:
+            raise ValueError("there must be at least one stack per player")
+        self.size = size
+        self.num_sizes = num_sizes
+        self.num_stacks = num_stacks
+        self.num_squares = size * size
+        self.board_mask = (1 << self.num_squares) - 1
+        self.square_names = [ chr(ord("A") + sq // size) + chr(ord("A") + sq % size)
+                              for sq in range(self.num_squares) ]
+        self.square_index = { name: sq for sq, name in enumerate(self.square_names) }
+        self.square_coords = [ divmod(sq, size) for sq in range(self.num_squares) ]
+        self.slot_sizes = [ str(num_sizes - slot) for slot in range(num_sizes) ]
+
+        # The winning lines: rows, then columns, then the 2 diagonals, and the
+        # indexes of the lines (2 or 3) that pass through each square
+        self.line_masks = []
+        for row in range(size):
+            self.line_masks.append(sum(1 << (row * size + column) for column in range(size)))
+        for column in range(size):
+            self.line_masks.append(sum(1 << (row * size + column) for row in range(size)))
+        self.line_masks.append(sum(1 << (diag * size + diag) for diag in range(size)))
+        self.line_masks.append(sum(1 << ((size - 1 - diag) * size + diag) for diag in range(size)))
+        self.num_lines = len(self.line_masks)
+        self.square_lines = [ [ line for line, mask in enumerate(self.line_masks) if mask & (1 << sq) ]
+                              for sq in range(self.num_squares) ]
+        # The same as a (squares, lines) 0/1 matrix, for counting the pieces
+        # in every line of a batch of positions with one matrix product. It is
+        # floating point, as NumPy multiplies float matrices many times faster
+        # than integer ones, and small counts are exact either way.
+        self.line_matrix = None
+        if numpy is not None:
+            self.line_matrix = numpy.array([ [ (mask >> sq) & 1 for mask in self.line_masks ]
+                                            for sq in range(self.num_squares) ], dtype=numpy.float32)
+
+        # The central squares (the middle 2x2 on even boards, the middle
+        # square on odd ones), and the names of the features of the
+        # parameterized evaluation, in the order of Gobblet.eval_features
+        middle = range((size - 1) // 2, size // 2 + 1)
+        self.center_mask = sum(1 << (row * size + column) for row in middle for column in middle)
+        self.feature_names = ([ f"own_line_{count}" for count in range(1, size) ]
+                              + [ f"other_line_{count}" for count in range(1, size) ]
+                              + [ "own_gobble", "other_gobble" ]
+                              + [ f"reserve_{size_name}" for size_name in self.slot_sizes ]
+                              + [ "center" ])
+
+        # Squares of each possible value of each byte of a mask
+        self.num_chunks = (self.num_squares + 7) // 8
+        self.chunk_squares = [ [ [ bit + 8 * chunk for bit in squares ] for squares in BYTE_SQUARES ]
+                               for chunk in range(max(2, self.num_chunks)) ]
+
+        # Zobrist keys for hashing a position: one random 64-bit key per
+        # player, slot and square, one per player, stack and stack height, and
+        # one per side to move. A fixed seed keeps hashes the same from one
+        # run to the next.
+        zobrist_random = random.Random(0x60bb1e7)
+        self.piece_keys = [ [ [ zobrist_random.getrandbits(64) for sq in range(self.num_squares) ]
+                              for slot in range(num_sizes) ] for player in range(2) ]
+        self.stack_keys = [ [ [ zobrist_random.getrandbits(64) for height in range(num_sizes + 1) ]
+                              for stack in range(num_stacks) ] for player in range(2) ]
+        self.side_keys = [ zobrist_random.getrandbits(64) for player in range(2) ]
+
+        # The 8 symmetries of the board (rotations and reflections), each
+        # mapping a (row, column) square to its image. All of them map the
+        # winning lines onto each other.
+        last = size - 1
+        symmetries = [
+            lambda row, column: (row, column),                # identity
+            lambda row, column: (column, last - row),         # rotate 90
+            lambda row, column: (last - row, last - column),  # rotate 180
+            lambda row, column: (last - column, row),         # rotate 270
+            lambda row, column: (last - row, column),         # flip rows
+            lambda row, column: (row, last - column),         # flip columns
+            lambda row, column: (column, row),                # main diagonal
+            lambda row, column: (last - column, last - row),  # anti-diagonal
+        ]
+        self.sym_squares = []
+        for sym in symmetries:
+            images = [ sym(row, column) for row, column in self.square_coords ]
+            self.sym_squares.append([ row * size + column for row, column in images ])
+        self.sym_names = [ { self.square_names[sq]: self.square_names[image]
+                             for sq, image in enumerate(squares) }
+                           for squares in self.sym_squares ]
+        self.sym_inverse = [ next(j for j in range(8)
+                                  if all(self.sym_squares[j][image] == sq
+                                         for sq, image in enumerate(squares)))
+                             for squares in self.sym_squares ]
+        # Image under each symmetry of each possible value of each byte of a mask
+        self.sym_chunks = []
+        for squares in self.sym_squares:
+            tables = []
+            for chunk in range(self.num_chunks):
+                table = []
+                for byte in range(256):
+                    image = 0
+                    for bit in BYTE_SQUARES[byte]:
+                        if bit + 8 * chunk < self.num_squares:
+                            image |= 1 << squares[bit + 8 * chunk]
+                    table.append(image)
+                tables.append(table)
+            self.sym_chunks.append(tables)
+
+    def mask_squares(self, mask):
+        # Return the square indexes of the set bits of 'mask'
+        squares = self.chunk_squares[0][mask & 0xFF] + self.chunk_squares[1][(mask >> 8) & 0xFF]
+        chunk = 2
+        mask >>= 16
+        while mask:
+            squares = squares + self.chunk_squares[chunk][mask & 0xFF]
+            mask >>= 8
+            chunk += 1
+        return squares
+
+    def transform_mask(self, sym, mask):
+        tables = self.sym_chunks[sym]
+        image = 0
+        chunk = 0
+        while mask:
+            image |= tables[chunk][mask & 0xFF]
+            mask >>= 8
+            chunk += 1
+        return image
+
+    def transform_move(self, sym, move, dest):
+        # Map a move to its image under a symmetry. New pieces keep their size.
+        names = self.sym_names[sym]
+        if len(move) == 2:
+            move = names[move]
+        return move, names[dest]
+
+    def encode_source(self, move):
+        # Number the source of a move for binary files: squares come first,
+        # then a new piece of each size from 1 up
+        if len(move) == 1:
+            return self.num_squares + int(move) - 1
+        return self.square_index[move]
+
+    def decode_source(self, code):
+        if code >= self.num_squares:
+            return str(code - self.num_squares + 1)
+        return self.square_names[code]
+
+def load_weights(path, board_size=4, num_sizes=4, num_stacks=3):
+    # Read the evaluation weights written by tune.py, for Gobblet(weights=...)
+    # with the given variant. Raises ValueError if they were tuned for
+    # another variant.
+    with open(path) as file:
+        tuned = json.load(file)
+    variant = (board_size, num_sizes, num_stacks)
+    if tuple(tuned["variant"]) != variant:
+        raise ValueError(f"{path} holds weights for variant {tuple(tuned['variant'])}, "
+                         f"not {variant}")
+    return tuned["weights"]
+
+def flip_notation(name):
+    # Convert a square name between internal notation, row letter first, and
+    # display notation, column letter first, as typed at the prompts of
+    # play(). Either way it is the same reversal, and a piece size is left
+    # as it is.
+    return name[::-1]
+
+# Geometries created so far, by (size, num_sizes, num_stacks)
+geometries = {}
+
+def get_geometry(size=4, num_sizes=4, num_stacks=3):
+    key = (size, num_sizes, num_stacks)
+    if key not in geometries:
+        geometries[key] = Geometry(size, num_sizes, num_stacks)
+    return geometries[key]
+
+# Transposition table bound types
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+class SearchTimeout(Exception):
+    # Raised inside the alpha-beta search when the per-move time budget runs out
+    pass
+
+class TranspositionTable:
+    # Fixed-size table of search results, indexed by the low bits of the
+    # position hash. Each slot holds one entry (key, depth, score, bound, move,
+    # generation) and the table never grows beyond the number of slots
+    # allocated for 'size_mb' megabytes.
+
+    # Approximate memory used per slot: the slot itself plus the entry tuple
+    # and the objects it refers to
+    entry_bytes = 200
+
+    def __init__(self, size_mb=16):
+        entries = max(1, int(size_mb * 1024 * 1024) // self.entry_bytes)
+        # Round down to a power of two, so a key maps to a slot with a mask
+        size = 1 << (entries.bit_length() - 1)
+        self.mask = size - 1
+        self.entries = [ None ] * size
+        self.generation = 0
+
+    def clear(self):
+        self.entries = [ None ] * (self.mask + 1)
+
+    def new_search(self):
+        # Entries from earlier searches are replaced first
+        self.generation += 1
+
+    def probe(self, key):
+        entry = self.entries[key & self.mask]
+        if entry and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key, depth, score, bound, move):
+        # Keep the existing entry only if it is for another position from
+        # the current search and was searched deeper
+        index = key & self.mask
+        entry = self.entries[index]
+        if entry and entry[0] != key and entry[5] == self.generation and entry[1] > depth:
+            return
+        self.entries[index] = (key, depth, score, bound, move, self.generation)
+
 class Gobblet:
 
-    def __init__(self):
+    def __init__(self, think_ms=None, tt_mb=16, workers=1, book=None,
+                 board_size=4, num_stacks=3, num_sizes=4, seed=None, trace=None, mcts=None,
+                 pns=None, weights=None):
+        # The standard game is played on a 4x4 board with 3 stacks of 4 sizes
+        # for each player, but smaller variants such as 3x3 with 2 stacks of
+        # 3 sizes can be set up with board_size, num_stacks and num_sizes.
+        self.geo = get_geometry(board_size, num_sizes, num_stacks)
+        self.board_size = board_size
+        self.num_stacks = num_stacks
+        self.num_sizes = num_sizes
         # Board is a square array, each element of which is an array of 4 pieces, where
-        # each piece has a size 1-4 and color (1 or 2). Board starts out empty.
-        #self.board = [ [ [0, 1, 2, 1] for _ in range(4)] for _ in range(4)]
-        #self.board = [ [ [0, 0, 0, 0], [0, 0, 0, 1], [0, 2, 2, 2], [1, 2, 1, 2] ],
-        #              [ [0, 0, 0, 0], [0, 0, 0, 2], [0, 1, 0, 0], [1, 0, 0, 0] ],
-        #              [ [0, 1, 2, 1], [1, 2, 1, 2], [0, 0, 0, 0], [2, 2, 1, 0] ],
-        #              [ [1, 2, 1, 1], [0, 0, 0, 1], [0, 2, 0, 0], [1, 0, 0, 0] ] ]
-        self.board = [ [ [0, 0, 0, 0] for _ in range(4)] for _ in range(4)]
-        self.player_stacks = [ [ 4, 4, 4 ], [ 4, 4, 4 ] ]
+        # each piece has a size 1-4 and color (1 or 2). Board starts out empty;
+        # other positions can be set up from text with parse_position and
+        # set_position (see position_string for the notation).
+        self.board = [ [ [0] * num_sizes for _ in range(board_size)] for _ in range(board_size)]
+        self.player_stacks = [ [ num_sizes ] * num_stacks, [ num_sizes ] * num_stacks ]
         self.player_chars = [ "X", "O" ]
         self.computer_players = [ False, False ]
+        # With quiet set, invalid moves are not reported on the terminal, only
+        # kept in move_error
+        self.quiet = False
+        self.move_error = None
         self.empty_piece = "  "
-        self.empty_row = "  |    |    |    |    |"
-        self.row_labels = "DCBA"
+        self.empty_row = "  |" + "    |" * board_size
+        self.column_labels = "".join(chr(ord("A") + column) for column in range(board_size))
+        self.row_labels = self.column_labels[::-1]
         self.num_moves = 0
+        # Game history, to end games that go nowhere: the number of times
+        # each position (hash and side to move) has been reached, and the
+        # moves since a new piece last came onto the board. A game is drawn
+        # when a position comes up repetition_limit times, or when stuck_moves
+        # moves go by with only pieces on the board moving (0 to never end a
+        # game this way). play() also stops after max_moves moves, if set.
+        self.position_counts = {}
+        self.quiet_moves = 0
+        self.repetition_limit = 3
+        self.stuck_moves = 50
+        self.max_moves = None
+        # How the last game played by play() or play_headless ended: "win",
+        # "repetition", "stuck", "move cap" or "no moves"
+        self.end_reason = None
+        # Source of the random scores of evaluate_board. Give a seed to make
+        # the computer's moves, and so whole games, reproducible. With noise
+        # off, quiet positions score 0 and the parameterized evaluation adds
+        # no noise, so that every score depends on the position alone.
+        self.random = random.Random(seed)
+        self.noise = True
         self.huge_score = 1000000
         self.big_score = 10000
+        # Searched wins and losses score beyond anything evaluate_board returns
+        self.win_score = 10 * self.huge_score
+        # Weights of the parameterized evaluation (see set_weights), or None
+        # for the original evaluation
+        self.weights = None
+        self.set_weights(weights)
+        # With think_ms set, the computer searches as deep as it can within
+        # that many milliseconds per move, instead of looking one move ahead
+        self.think_ms = think_ms
+        self.max_depth = 32
+        self.deadline = 0
+        self.search_depth = 0
+        # Counters of the work done choosing the current move (see
+        # reset_stats), and a summary of the last move chosen
+        self.nodes = 0
+        self.moves_made = 0
+        self.moves_generated = 0
+        self.evaluations = 0
+        self.tt_hits = 0
+        self.tt_misses = 0
+        self.cutoffs = 0
+        self.stats = {}
+        # With a trace file, the stats of each computer move are appended to it
+        # as a JSON line, and the time spent in move generation, make_move and
+        # undo_move, and evaluate_board is measured too
+        self.trace_file = None
+        self.timings = None
+        if trace:
+            self.trace_file = open(trace, "a")
+            self.enable_timings()
+        # Transposition table for the search, capped at tt_mb megabytes
+        self.tt = TranspositionTable(tt_mb)
+        self.tt_mb = tt_mb
+        # Scores of the root moves after each completed search depth, and a
+        # function called as depth_callback(depth, best) after each one, such
+        # as engine.py reporting the progress of its searches
+        self.depth_results = []
+        self.depth_callback = None
+        self.path_keys = set()
+        # With more than one worker, the root moves are searched in parallel
+        # by a pool of worker processes, created on first use
+        self.workers = workers
+        self.pool = None
+        self.parallel_stats = {}
+        # Opening book (see book.py) consulted before searching
+        self.book = book
+        # Monte Carlo tree search player (see mcts.py), used instead of the
+        # alpha-beta search or one move of lookahead if given
+        self.mcts = mcts
+        # Proof-number search (see pns.py), tried first in sharp positions to
+        # find forced wins, if given, for at most pns_share of think_ms
+        self.pns = pns
+        self.pns_share = 0.25
+        # Bitboards mirroring self.board: one mask per player and slot, where
+        # slot 0 holds the largest pieces and the last slot the size 1 pieces
+        self.pieces = [ [ 0 ] * num_sizes, [ 0 ] * num_sizes ]
+        # Zobrist hash of the board slots and player stacks
+        self.hash = 0
+        # Owner of the outermost piece of each square (0 if empty), and for
+        # each player the number of squares in each line that they own
+        self.top_owner = [ 0 ] * self.geo.num_squares
+        self.line_counts = [ [ 0 ] * self.geo.num_lines, [ 0 ] * self.geo.num_lines ]
+        self.sync_bitboards()
+
+    def set_position(self, board, stacks):
+        # Set up a position from a board and player stacks in the format of
+        # self.board and self.player_stacks
+        self.board = [ [ list(square) for square in row ] for row in board ]
+        self.player_stacks = [ list(player_stacks) for player_stacks in stacks ]
+        self.sync_bitboards()
+        self.position_counts = {}
+        self.quiet_moves = 0
+
+    def reset_history(self, player):
+        # Start the game history at the current position with 'player' to move
+        self.position_counts = { self.hash ^ self.geo.side_keys[player - 1]: 1 }
+        self.quiet_moves = 0
+
+    def record_move(self, player, move):
+        # Add the position reached by a game move of 'player' to the history.
+        # Returns "repetition" or "stuck" if the game is drawn by it, or None.
+        if len(move) == 1:
+            self.quiet_moves = 0
+        else:
+            self.quiet_moves += 1
+        key = self.hash ^ self.geo.side_keys[2 - player]
+        count = self.position_counts.get(key, 0) + 1
+        self.position_counts[key] = count
+        if count >= self.repetition_limit:
+            return "repetition"
+        if self.stuck_moves and self.quiet_moves >= self.stuck_moves:
+            return "stuck"
+        return None
+
+    def position_string(self, player):
+        # Write the position with 'player' to move as one line of text: the
+        # board, the player stacks and the side to move, separated by spaces.
+        # The board lists rows A first and the squares of each row column A
+        # first, with "/" between rows and "," between squares. A square is
+        # "." if empty, or else its pieces from the largest down, each as the
+        # owner's character and the piece size, e.g. "X4O2". The stacks are
+        # the heights of each player's stacks, with "/" between the players.
+        # The start of the standard game is:
+        #   .,.,.,./.,.,.,./.,.,.,./.,.,.,. 444/444 X
+        rows = []
+        for row in self.board:
+            squares = []
+            for square in row:
+                pieces = "".join(self.player_chars[owner - 1] + self.geo.slot_sizes[slot]
+                                 for slot, owner in enumerate(square) if owner)
+                squares.append(pieces or ".")
+            rows.append(",".join(squares))
+        stacks = "/".join("".join(str(height) for height in player_stacks)
+                          for player_stacks in self.player_stacks)
+        return f"{'/'.join(rows)} {stacks} {self.player_chars[player - 1]}"
+
+    def parse_position(self, text):
+        # Read a position written by position_string for this variant and
+        # return (board, stacks, player), raising ValueError if it is not
+        # valid. Only the format is checked, not whether the position can be
+        # reached in a game.
+        fields = text.split()
+        if len(fields) != 3:
+            raise ValueError("position must have a board, stacks and side to move")
+        board_text, stacks_text, side = fields
+        if side not in self.player_chars:
+            raise ValueError(f"side to move must be {' or '.join(self.player_chars)}")
+        player = self.player_chars.index(side) + 1
+
+        rows = board_text.split("/")
+        if len(rows) != self.board_size:
+            raise ValueError(f"board must have {self.board_size} rows")
+        board = []
+        counts = [ [ 0 ] * self.num_sizes, [ 0 ] * self.num_sizes ]
+        for row_text in rows:
+            squares = row_text.split(",")
+            if len(squares) != self.board_size:
+                raise ValueError(f"each row must have {self.board_size} squares")
+            row = []
+            for square_text in squares:
+                square = [ 0 ] * self.num_sizes
+                if square_text != ".":
+                    if not square_text or len(square_text) % 2:
+                        raise ValueError(f"bad square {square_text!r}")
+                    last_slot = -1
+                    for i in range(0, len(square_text), 2):
+                        owner_char, size_char = square_text[i:i + 2]
+                        if owner_char not in self.player_chars or size_char not in self.geo.slot_sizes:
+                            raise ValueError(f"bad square {square_text!r}")
+                        slot = self.geo.slot_sizes.index(size_char)
+                        if slot <= last_slot:
+                            raise ValueError(f"pieces of square {square_text!r} must go largest first")
+                        owner = self.player_chars.index(owner_char) + 1
+                        square[slot] = owner
+                        counts[owner - 1][slot] += 1
+                        last_slot = slot
+                row.append(square)
+            board.append(row)
+
+        stacks = []
+        for owner, heights in enumerate(stacks_text.split("/")):
+            if owner > 1 or len(heights) != self.num_stacks or not heights.isdigit():
+                raise ValueError(f"stacks must be 2 groups of {self.num_stacks} heights")
+            player_stacks = [ int(height) for height in heights ]
+            if max(player_stacks) > self.num_sizes:
+                raise ValueError(f"stacks must be at most {self.num_sizes} high")
+            # Each stack still holds every size up to its height, and the
+            # pieces of the other sizes must be on the board
+            for slot, size in enumerate(range(self.num_sizes, 0, -1)):
+                in_stacks = sum(1 for height in player_stacks if height >= size)
+                if in_stacks + counts[owner][slot] != self.num_stacks:
+                    raise ValueError(f"pieces of size {size} of player {owner + 1} do not add up")
+            stacks.append(player_stacks)
+        if len(stacks) != 2:
+            raise ValueError(f"stacks must be 2 groups of {self.num_stacks} heights")
+        return board, stacks, player
+
+    def sync_bitboards(self):
+        # Rebuild the bitboards from self.board after it has been changed
+        self.pieces = [ [ 0 ] * self.num_sizes, [ 0 ] * self.num_sizes ]
+        self.top_owner = []
+        for sq, (row, column) in enumerate(self.geo.square_coords):
+            square = self.board[row][column]
+            for slot in range(self.num_sizes):
+                if square[slot]:
+                    self.pieces[square[slot] - 1][slot] |= 1 << sq
+            self.top_owner.append(self.get_outermost(square) or 0)
+        self.hash = self.compute_hash()
+        self.line_counts = [ [ 0 ] * self.geo.num_lines, [ 0 ] * self.geo.num_lines ]
+        for sq, owner in enumerate(self.top_owner):
+            self.update_lines(sq, 0, owner)
+
+    def update_lines(self, sq, old_owner, new_owner):
+        # The outermost piece of square 'sq' has changed owner
+        for line in self.geo.square_lines[sq]:
+            if old_owner:
+                self.line_counts[old_owner - 1][line] -= 1
+            if new_owner:
+                self.line_counts[new_owner - 1][line] += 1
+
+    def compute_hash(self):
+        # Hash the position from scratch; make_move keeps self.hash up to date
+        hash = 0
+        for player in range(2):
+            for slot in range(self.num_sizes):
+                for sq in self.geo.mask_squares(self.pieces[player][slot]):
+                    hash ^= self.geo.piece_keys[player][slot][sq]
+            for stack, height in enumerate(self.player_stacks[player]):
+                hash ^= self.geo.stack_keys[player][stack][height]
+        return hash
+
+    def get_top_masks(self):
+        # Return the squares where player 1 and player 2 own the outermost
+        # piece, i.e. the visible board
+        x_pieces, o_pieces = self.pieces
+        x_top = 0
+        o_top = 0
+        covered = 0
+        for slot in range(self.num_sizes):
+            x_top |= x_pieces[slot] & ~covered
+            o_top |= o_pieces[slot] & ~covered
+            covered |= x_pieces[slot] | o_pieces[slot]
+        return x_top, o_top
+
+    def get_free_masks(self):
+        # For each slot, return the squares that a piece of that slot's size
+        # may be placed on: those with no piece of the same size or larger
+        x_pieces, o_pieces = self.pieces
+        free = []
+        covered = 0
+        for slot in range(self.num_sizes):
+            covered |= x_pieces[slot] | o_pieces[slot]
+            free.append(self.geo.board_mask & ~covered)
+        return free
 
     def show_board(self):
         row1 = self.empty_row
@@ -119,12 +630,14 @@ class Gobblet:
                 # column will be a list like [ 0, 2, 1, 2 ] where the first element
                 # is the outermost piece of size 4, next of size 3, then size 2, and
                 # finally size 1. A zero means no piece of that size exists in that square.
+                # With fewer than 4 sizes, the largest piece is drawn as a size
+                # num_sizes piece rather than as a size 4 one.
                 square_is_empty = True
-                for size in range(4):
+                for size in range(self.num_sizes):
                     if column[size] == 0:
                         continue
-                    piece_row1 = self.gen_row1(size, column[size])
-                    piece_row2 = self.gen_row2(size, column[size])
+                    piece_row1 = self.gen_row1(size + 4 - self.num_sizes, column[size])
+                    piece_row2 = self.gen_row2(size + 4 - self.num_sizes, column[size])
                     # Replace 2 chars of row1 and row2 with chars reflecting what's visible
                     start_index = 4 + 5 * col_num
                     row1 = row1[0:start_index] + piece_row1 + row1[start_index+2:]
@@ -173,77 +686,27 @@ class Gobblet:
                 return "  "
 
     def print_horiz_line(self):
-        print("  +----+----+----+----+")
+        print("  +" + "----+" * self.board_size)
 
     def print_horiz_labels(self):
-        print("    A    B    C    D")
+        print("    " + "    ".join(self.column_labels))
 
     def get_outermost(self, square):
-        for size in range(4):
-            if square[size]:
-                return square[size]
+        for piece in square:
+            if piece:
+                return piece
 
         return None
 
-    def map_player(self, player):
-        if player == 1:
-            return -1
-        else:
-            return 1
-
     def is_a_winner(self, player):
         # Look for a row, column, or diagonal of one color
         # and if found, the player has won. Note that we look first for the
         # other player than the one who just had a turn, since uncovering a
         # piece resulting in the opponent having a line of 4 will lose the game
         # for the player whose turn it was.
-
-        # Map current player 1 to value -1, player 2 to value 1
-        player_val = self.map_player(player)
-
-        # Look for rows first
-        for row in range(4):
-            row_total = 0
-            for column in range(4):
-                piece = self.get_outermost(self.board[row][column])
-                if piece:
-                    # Map player 1 to value -1, player 2 to value 1
-                    row_total += self.map_player(piece)
-            # Check other player first
-            if row_total == -4 * player_val:
-                return 3 - player
-            elif row_total == 4 * player_val:
-                return player
-
-        # Look for columns next
-        for column in range(4):
-            column_total = 0
-            for row in range(4):
-                piece = self.get_outermost(self.board[row][column])
-                if piece:
-                    # Map player 1 to value -1, player 2 to value 1
-                    column_total += self.map_player(piece)
-            # Check other player first
-            if column_total == -4 * player_val:
-                return 3 - player
-            elif column_total == 4 * player_val:
-                return player
-
-        # Finally, look for diagonals
-        diag_total1 = 0
-        diag_total2 = 0
-        for diag in range(4):
-            piece = self.get_outermost(self.board[diag][diag])
-            if piece:
-                diag_total1 += self.map_player(piece)
-            piece = self.get_outermost(self.board[3 - diag][diag])
-            if piece:
-                diag_total2 += self.map_player(piece)
-
-        # Check other player first
-        if diag_total1 == -4 * player_val or diag_total2 == -4 * player_val:
+        if self.board_size in self.line_counts[2 - player]:
             return 3 - player
-        elif diag_total1 == 4 * player_val or diag_total2 == 4 * player_val:
+        if self.board_size in self.line_counts[player - 1]:
             return player
 
         return False
@@ -255,6 +718,13 @@ class Gobblet:
             return True
         return False
 
+    def reject_move(self, message):
+        # Report why a move entered is not valid, keeping the reason for
+        # callers that do not use the terminal, such as server.py
+        self.move_error = message
+        if not self.quiet:
+            print(message)
+
     def check_from(self, player, move):
         # A move must be a single digit specifying the size of a piece in
         # the player's stacks to add to the board, or a two character x/y
@@ -262,126 +732,267 @@ class Gobblet:
 
         if len(move) == 1:
             size = int(move)
-            if size < 1 or size > 4:
-                print("Invalid move: size must be 1-4")
+            if size < 1 or size > self.num_sizes:
+                self.reject_move(f"Invalid move: size must be 1-{self.num_sizes}")
                 return None
             # Make sure player has an outermost piece of that size
             if size not in self.player_stacks[player - 1]:
-                print(f"Invalid move: player {player} has no usable piece of size {size}")
+                self.reject_move(f"Invalid move: player {player} has no usable piece of size {size}")
                 return None
             return size
         elif len(move) == 2:
             if move[0] not in self.row_labels or move[1] not in self.row_labels:
-                print("Invalid move: characters must be A-D")
+                self.reject_move(f"Invalid move: characters must be A-{self.row_labels[0]}")
                 return None
             # Make sure there is a piece of the player's color at the grid location
             x = ord(move[0]) - ord("A")
             y = ord(move[1]) - ord("A")
-            for i in range(4):
+            for i in range(self.num_sizes):
                 size = self.board[x][y][i]
                 if size == 0:
                     continue
                 if player != size:
-                    print("Invalid move: player does not have a piece at that location")
+                    self.reject_move("Invalid move: player does not have a piece at that location")
                     return None
                 else:
-                    return 4 - i
-            print("Invalid move: player does not have a piece at that location")
+                    return self.num_sizes - i
+            self.reject_move("Invalid move: player does not have a piece at that location")
             return None
 
         else:
-            print("Invalid move: expected size 1-4 or 2-character grid co-ordinate")
+            self.reject_move(f"Invalid move: expected size 1-{self.num_sizes} or 2-character grid co-ordinate")
             return None
 
     def check_to(self, player, size, dest):
         if len(dest) != 2:
-            print("Invalid move: expected 2 characters")
+            self.reject_move("Invalid move: expected 2 characters")
             return False
         if dest[0] not in self.row_labels or dest[1] not in self.row_labels:
-            print("Invalid move: destination characters must be A-D")
+            self.reject_move(f"Invalid move: destination characters must be A-{self.row_labels[0]}")
             return False
 
         # Check that piece of size 'size' can be placed at 'dest',
         # which means that no piece of equal or larger size exists there.
         dx = ord(dest[0]) - ord("A")
         dy = ord(dest[1]) - ord("A")
-        for i in range(size, 5):
-            if self.board[dx][dy][4 - i]:
-                print("Invalid move: destination contains a piece of the same size or larger")
+        for i in range(size, self.num_sizes + 1):
+            if self.board[dx][dy][self.num_sizes - i]:
+                self.reject_move("Invalid move: destination contains a piece of the same size or larger")
                 return False
 
         return True
 
     def get_legal_destinations(self, player, size):
-        # Look at each board square and determine if it contains nothing,
-        # or as its largest piece, a piece smaller than 'size'. If so, it's a legal
-        # destination square for the move being considered.
-
-        sizeidx = 4 - size
-        destinations = []
-
-        for rowidx, row in enumerate(self.board):
-            rowname = chr(ord("A") + rowidx)
-            for colidx, column in enumerate(row):
-                colname = chr(ord("A") + colidx)
-                square_allowed = True
-                for slot in range(0, sizeidx + 1):
-                    #print(f"XXX: size {size} rowname {rowname} colname {colname} slot {slot} column[slot] {column[slot]}")
-                    if column[slot] != 0:
-                        square_allowed = False
-                        break
-                if square_allowed:
-                    dest = rowname + colname
-                    #print(f"Adding {dest} to allowed destinations")
-                    destinations.append(dest)
+        # A square is a legal destination for a piece of 'size' if it contains
+        # nothing, or as its largest piece, a piece smaller than 'size'.
+        free = self.get_free_masks()[self.num_sizes - size]
+        return [ self.geo.square_names[sq] for sq in self.geo.mask_squares(free) ]
 
-        return destinations
-
-    def get_legal_moves(self, player):
+    def get_legal_moves(self, player, unique=False):
         # Generate all legal moves based on the current board and stack states
         # for the given player, by first looking at adding pieces to the board,
         # and then by moving the player's pieces that are already on the board.
         # A 'move' consists of a size/dest pair for a new piece, or a src/dest
-        # pair for an already-played piece.
+        # pair for an already-played piece. With 'unique', moves that are
+        # mirror images of an earlier move under a symmetry of the current
+        # position are left out.
         moves = []
+        free = self.get_free_masks()
+        square_names = self.geo.square_names
+        mask_squares = self.geo.mask_squares
 
+        sizes_seen = []
         for size in self.player_stacks[player - 1]:
-            if size == 0:
+            # Stacks with the same top size give identical moves
+            if size == 0 or size in sizes_seen:
                 continue
-            destinations = self.get_legal_destinations(player, size)
-            if not destinations:
+            sizes_seen.append(size)
+            slot = self.num_sizes - size
+            size_name = self.geo.slot_sizes[slot]
+            for sq in mask_squares(free[slot]):
+                moves.append([size_name, square_names[sq], 0])
+
+        # A player's piece can move if it is the outermost piece on its square.
+        # Its source square is never in free[slot], since the piece itself
+        # occupies that slot.
+        own_pieces = self.pieces[player - 1]
+        x_pieces, o_pieces = self.pieces
+        covered = 0
+        for slot in range(self.num_sizes):
+            movable = own_pieces[slot] & ~covered
+            covered |= x_pieces[slot] | o_pieces[slot]
+            if not movable:
                 continue
-            for dest in destinations:
-                move = [str(size), dest, 0]
-                moves.append(move)
-
-        for rowidx, row in enumerate(self.board):
-            rowname = chr(ord("A") + rowidx)
-            for colidx, column in enumerate(row):
-                colname = chr(ord("A") + colidx)
-                for slot in range(4):
-                    #print(f"glm: player {player} rowname {rowname} colname {colname} slot {slot} column[slot] {column[slot]}")
-                    if column[slot] == 0:
-                        continue
-                    if column[slot] != player:
-                        break
-                    size = 4 - slot
-                    destinations = self.get_legal_destinations(player, size)
-                    if not destinations:
-                        continue
-                    for dest in destinations:
-                        dx = ord(dest[0]) - ord("A")
-                        dy = ord(dest[1]) - ord("A")
-                        # Skip no-op moves where the destination is the source
-                        if dx == colidx and dy == rowidx:
-                            continue
-                        move = [rowname + colname, dest, 0]
-                        moves.append(move)
-
-        #print(f"glm: {moves}")
+            destinations = [ square_names[sq] for sq in mask_squares(free[slot]) ]
+            for src in mask_squares(movable):
+                src_name = square_names[src]
+                for dest in destinations:
+                    moves.append([src_name, dest, 0])
+
+        if unique:
+            moves = self.prune_symmetric_moves(moves)
+        self.moves_generated += len(moves)
         return moves
 
-    def evaluate_board(self, player, board):
+    def generate_moves(self, player):
+        # Yield the legal moves for 'player' as (move, dest) pairs, in stages,
+        # so that a search can stop as soon as it finds a decisive move:
+        #   1. moves that win at once
+        #   2. moves that looked like wins but were not, then moves onto a
+        #      line where the opponent has all but one square (3 pieces on
+        #      the standard board), which block the line or gobble one of its
+        #      pieces
+        #   3. other moves that gobble an opponent's piece
+        #   4. quiet moves
+        # Moves are produced stage by stage as the caller asks for them. The
+        # caller may make and undo moves between steps, as long as the
+        # position is the same each time the generator resumes.
+        free = self.get_free_masks()
+        player_counts = self.line_counts[player - 1]
+        other_counts = self.line_counts[2 - player]
+        tops = self.get_top_masks()
+        player_top = tops[player - 1]
+        other_top = tops[2 - player]
+        square_names = self.geo.square_names
+        mask_squares = self.geo.mask_squares
+
+        # Sources of moves: (size or square name, slot) for each new piece
+        # size available and each of the player's movable pieces
+        sources = []
+        for size in self.player_stacks[player - 1]:
+            slot = self.num_sizes - size
+            if size and (self.geo.slot_sizes[slot], slot) not in sources:
+                sources.append((self.geo.slot_sizes[slot], slot))
+        own_pieces = self.pieces[player - 1]
+        x_pieces, o_pieces = self.pieces
+        covered = 0
+        for slot in range(self.num_sizes):
+            for src in mask_squares(own_pieces[slot] & ~covered):
+                sources.append((square_names[src], slot))
+            covered |= x_pieces[slot] | o_pieces[slot]
+
+        threat = self.board_size - 1
+        win_dests = 0
+        block_dests = 0
+        if threat in player_counts:
+            for line, mask in enumerate(self.geo.line_masks):
+                if player_counts[line] == threat:
+                    win_dests |= mask & ~player_top
+        if threat in other_counts:
+            for line, mask in enumerate(self.geo.line_masks):
+                if other_counts[line] == threat:
+                    block_dests |= mask & ~player_top
+
+        # A move onto the missing square of a line usually wins, but not
+        # if it takes its piece from the same line or uncovers a line of the
+        # opponent's, so try each one
+        not_wins = []
+        if win_dests:
+            for source, slot in sources:
+                for sq in mask_squares(free[slot] & win_dests):
+                    dest = square_names[sq]
+                    undo = self.make_move(player, source, dest)
+                    winner = self.is_a_winner(player)
+                    self.undo_move(undo)
+                    if winner == player:
+                        self.moves_generated += 1
+                        yield source, dest
+                    else:
+                        not_wins.append((source, dest))
+        self.moves_generated += len(not_wins)
+        yield from not_wins
+
+        done = win_dests
+        for stage_dests in (block_dests, other_top, self.geo.board_mask):
+            stage_dests &= ~done
+            done |= stage_dests
+            if not stage_dests:
+                continue
+            for source, slot in sources:
+                for sq in mask_squares(free[slot] & stage_dests):
+                    self.moves_generated += 1
+                    yield source, square_names[sq]
+
+    def is_legal_move(self, player, move, dest):
+        # Check a move in internal notation, such as one from the
+        # transposition table, against the current position
+        free = self.get_free_masks()
+        dest_bit = 1 << self.geo.square_index[dest]
+        if len(move) == 1:
+            size = int(move)
+            return (size in self.player_stacks[player - 1]
+                    and bool(free[self.num_sizes - size] & dest_bit))
+
+        src_sq = self.geo.square_index[move]
+        if self.top_owner[src_sq] != player:
+            return False
+        row, column = self.geo.square_coords[src_sq]
+        square = self.board[row][column]
+        slot = 0
+        while not square[slot]:
+            slot += 1
+        return bool(free[slot] & dest_bit)
+
+    def get_symmetries(self):
+        # Return the symmetries, other than the identity, that map the
+        # current position onto itself
+        syms = []
+        for sym in range(1, 8):
+            if all(self.geo.transform_mask(sym, mask) == mask
+                   for player_pieces in self.pieces for mask in player_pieces):
+                syms.append(sym)
+        return syms
+
+    def prune_symmetric_moves(self, moves):
+        # Keep one move from each set of moves that lead to positions that
+        # are mirror images of each other
+        syms = self.get_symmetries()
+        if not syms:
+            return moves
+        kept = []
+        seen = set()
+        for m in moves:
+            if any(self.geo.transform_move(sym, m[0], m[1]) in seen for sym in syms):
+                continue
+            seen.add((m[0], m[1]))
+            kept.append(m)
+        return kept
+
+    def get_canonical(self):
+        # Return the canonical form of the position, the smallest of its 8
+        # symmetric images, as a tuple of the transformed bitboards followed by
+        # the sorted stack heights, together with the symmetry that maps the
+        # board onto it. Map moves found on the canonical board back with
+        # self.geo.transform_move(self.geo.sym_inverse[sym], move, dest).
+        stacks = tuple(sorted(self.player_stacks[0])) + tuple(sorted(self.player_stacks[1]))
+        best = None
+        best_sym = 0
+        for sym in range(8):
+            image = tuple(self.geo.transform_mask(sym, mask)
+                          for player_pieces in self.pieces for mask in player_pieces)
+            if best is None or image < best:
+                best = image
+                best_sym = sym
+        return best + stacks, best_sym
+
+    def canonical_hash(self):
+        # Zobrist hash of the canonical form, the same for all symmetric
+        # images of a position and for any order of equal-height stacks
+        canonical, sym = self.get_canonical()
+        num_masks = 2 * self.num_sizes
+        hash = 0
+        for index in range(num_masks):
+            keys = self.geo.piece_keys[index // self.num_sizes][index % self.num_sizes]
+            for sq in self.geo.mask_squares(canonical[index]):
+                hash ^= keys[sq]
+        for index, height in enumerate(canonical[num_masks:]):
+            hash ^= self.geo.stack_keys[index // self.num_stacks][index % self.num_stacks][height]
+        return hash, sym
+
+    def evaluate_board(self, player):
+        self.evaluations += 1
+        if self.weights is not None:
+            return self.evaluate_weighted(player)
         # Look for a row, column, or diagonal of one color,
         # and maintain a max score in the order:
         #   opponent: 4 in a line - huge negative score
@@ -389,128 +1000,762 @@ class Gobblet:
         #   opponent: 3 in a line and other empty - big negative score
         #   player:   3 in a line and other empty - big positive score
         #   anything else: random positive score up to half of 'big'
+        # (on other board sizes, a full line and a line missing one piece)
         #
         # Note that we look first for the
         # other player than the one who just had a turn, since uncovering a
         # piece resulting in the opponent having a line of 4 will lose the game
         # for the player whose turn it was.
+        #
+        # The per-line counts of visible pieces are kept up to date by
+        # make_move, so a line with 3 of one color and no piece of the other
+        # has exactly one empty square.
+        player_counts = self.line_counts[player - 1]
+        other_counts = self.line_counts[2 - player]
+        full = self.board_size
+        threat = full - 1
+        if max(player_counts) < threat and max(other_counts) < threat:
+            return self.random.randrange(self.big_score) if self.noise else 0
 
-        # Map current player 1 to value -1, player 2 to value 1
-        player_val = self.map_player(player)
         current_score = 0
 
-        # Look for rows first
-        for row in range(4):
-            row_total = 0
-            row_empty_total = 0
-            for column in range(4):
-                piece = self.get_outermost(board[row][column])
-                if piece:
-                    # Map player 1 to value -1, player 2 to value 1
-                    row_total += self.map_player(piece)
-                else:
-                    # Count empty squares in this row
-                    row_empty_total += 1
-            # Check other player first
-            if row_total == -4 * player_val:
-                return -self.huge_score
-            elif row_total == 4 * player_val:
-                return self.huge_score
-            elif row_total == -3 * player_val and row_empty_total == 1:
-                current_score = -self.big_score
-            elif row_total == 3 * player_val and row_empty_total == 1:
-                current_score = self.big_score
-
-        # Look for columns next
-        for column in range(4):
-            column_total = 0
-            column_empty_total = 0
-            for row in range(4):
-                piece = self.get_outermost(board[row][column])
-                if piece:
-                    # Map player 1 to value -1, player 2 to value 1
-                    column_total += self.map_player(piece)
-                else:
-                    # Count empty squares in this column
-                    column_empty_total += 1
+        # Rows and columns first
+        diag1 = 2 * full
+        diag2 = diag1 + 1
+        for line in range(diag1):
+            player_count = player_counts[line]
+            other_count = other_counts[line]
             # Check other player first
-            if column_total == -4 * player_val:
+            if other_count == full:
                 return -self.huge_score
-            elif column_total == 4 * player_val:
+            elif player_count == full:
                 return self.huge_score
-            elif column_total == -3 * player_val and column_empty_total == 1:
+            elif other_count == threat and player_count == 0:
                 current_score = -self.big_score
-            elif column_total == 3 * player_val and column_empty_total == 1:
+            elif player_count == threat and other_count == 0:
                 current_score = self.big_score
 
-        # Finally, look for diagonals
-        diag_total1 = 0
-        diag_empty_total1 = 0
-        diag_total2 = 0
-        diag_empty_total2 = 0
-        for diag in range(4):
-            piece = self.get_outermost(board[diag][diag])
-            if piece:
-                diag_total1 += self.map_player(piece)
-            else:
-                diag_empty_total1 += 1
-            piece = self.get_outermost(board[3 - diag][diag])
-            if piece:
-                diag_total2 += self.map_player(piece)
-            else:
-                diag_empty_total2 += 1
-
-        # Check other player first
-        if diag_total1 == -4 * player_val or diag_total2 == -4 * player_val:
+        # Finally, the diagonals
+        if other_counts[diag1] == full or other_counts[diag2] == full:
             return -self.huge_score
-        elif diag_total1 == 4 * player_val or diag_total2 == 4 * player_val:
+        elif player_counts[diag1] == full or player_counts[diag2] == full:
             return self.huge_score
-        elif diag_total1 == -3 * player_val and diag_empty_total1 == 1:
+        elif other_counts[diag1] == threat and player_counts[diag1] == 0:
             current_score = -self.huge_score
-        elif diag_total2 == -3 * player_val and diag_empty_total2 == 1:
+        elif other_counts[diag2] == threat and player_counts[diag2] == 0:
             current_score = -self.huge_score
-        elif diag_total1 == 3 * player_val and diag_empty_total1 == 1:
+        elif player_counts[diag1] == threat and other_counts[diag1] == 0:
             current_score = self.huge_score
-        elif diag_total2 == 3 * player_val and diag_empty_total2 == 1:
+        elif player_counts[diag2] == threat and other_counts[diag2] == 0:
             current_score = self.huge_score
 
         if current_score:
             return current_score
         else:
-            return random.randrange(self.big_score)
+            return self.random.randrange(self.big_score) if self.noise else 0
+
+    def set_weights(self, weights):
+        # Score positions with the parameterized evaluation, given a dict of
+        # integer weights by feature name (see eval_features), or with the
+        # original evaluation for None. Every feature of the variant must be
+        # given, so that weights for another variant are not taken for these,
+        # and "noise" adds a random amount below it to every score, so that
+        # games between the same players vary.
+        if weights is None:
+            self.weights = None
+            self.eval_weights = None
+            return
+        names = self.geo.feature_names
+        unknown = set(weights) - set(names) - { "noise" }
+        if unknown:
+            raise ValueError(f"unknown evaluation features: {', '.join(sorted(unknown))}")
+        missing = set(names) - set(weights)
+        if missing:
+            raise ValueError(f"missing evaluation features: {', '.join(sorted(missing))}")
+        self.eval_weights = dict(weights)
+        self.weights = [ int(weights[name]) for name in names ]
+        self.eval_noise = int(weights.get("noise", 0))
+        # Tables for evaluate_weighted: the weight of a line by the number
+        # of squares each player owns in it, and the weight of a stack of
+        # each height, from the weights of the sizes it holds
+        full = self.board_size
+        own_lines = [ 0 ] + self.weights[:full - 1] + [ 0 ]
+        other_lines = [ 0 ] + self.weights[full - 1:2 * full - 2] + [ 0 ]
+        self.line_weights = [ [ own_lines[own] if not other else other_lines[other] if not own else 0
+                                for other in range(full + 1) ] for own in range(full + 1) ]
+        self.own_gobble_weight, self.other_gobble_weight = self.weights[2 * full - 2:2 * full]
+        reserve_weights = self.weights[2 * full:2 * full + self.num_sizes]
+        self.stack_weights = [ sum(reserve_weights[self.num_sizes - height:])
+                               for height in range(self.num_sizes + 1) ]
+        self.center_weight = self.weights[-1]
+
+    def eval_features(self, player):
+        # The features of the position for the parameterized evaluation, from
+        # the point of view of 'player', who has just moved, in the order of
+        # geo.feature_names:
+        #   own_line_N, other_line_N: lines where only the player (or only
+        #     the opponent) has visible pieces, N of them
+        #   own_gobble, other_gobble: visible pieces of the opponent (or the
+        #     player) smaller than the largest piece in the player's (or the
+        #     opponent's) stacks, which could be gobbled from the stacks
+        #   reserve_S: pieces of size S in the player's stacks, less the
+        #     opponent's
+        #   center: central squares where the player's piece is visible, less
+        #     those where the opponent's is
+        full = self.board_size
+        own_lines = [ 0 ] * (full + 1)
+        other_lines = [ 0 ] * (full + 1)
+        for own_count, other_count in zip(self.line_counts[player - 1], self.line_counts[2 - player]):
+            if not other_count:
+                own_lines[own_count] += 1
+            elif not own_count:
+                other_lines[other_count] += 1
+
+        # Visible pieces of each slot
+        own_pieces = self.pieces[player - 1]
+        other_pieces = self.pieces[2 - player]
+        own_tops = []
+        other_tops = []
+        covered = 0
+        for slot in range(self.num_sizes):
+            own_tops.append(own_pieces[slot] & ~covered)
+            other_tops.append(other_pieces[slot] & ~covered)
+            covered |= own_pieces[slot] | other_pieces[slot]
+
+        own_stacks = self.player_stacks[player - 1]
+        other_stacks = self.player_stacks[2 - player]
+        # Slot of the largest piece in each player's stacks, which is beyond
+        # the last slot if the stacks are empty
+        own_slot = self.num_sizes - max(own_stacks)
+        other_slot = self.num_sizes - max(other_stacks)
+        own_gobble = sum(bin(mask).count("1") for mask in other_tops[own_slot + 1:])
+        other_gobble = sum(bin(mask).count("1") for mask in own_tops[other_slot + 1:])
+        reserves = [ sum(1 for height in own_stacks if height >= size)
+                     - sum(1 for height in other_stacks if height >= size)
+                     for size in range(self.num_sizes, 0, -1) ]
+        center = self.geo.center_mask
+        center_count = (bin(center & sum(own_tops)).count("1")
+                        - bin(center & sum(other_tops)).count("1"))
+        return (own_lines[1:full] + other_lines[1:full] + [ own_gobble, other_gobble ] + reserves
+                + [ center_count ])
+
+    def evaluate_weighted(self, player):
+        # The parameterized evaluation of the position for 'player', who has
+        # just moved: a full line scores huge_score as in evaluate_board,
+        # checking the opponent first, and anything else the weighted sum of
+        # eval_features, plus the noise, kept short of huge_score
+        full = self.board_size
+        if full in self.line_counts[2 - player]:
+            return -self.huge_score
+        if full in self.line_counts[player - 1]:
+            return self.huge_score
+        # The weighted sum of eval_features, worked out feature by feature
+        # straight from the board, which is several times faster
+        line_weights = self.line_weights
+        score = sum([ line_weights[own_count][other_count] for own_count, other_count
+                      in zip(self.line_counts[player - 1], self.line_counts[2 - player]) ])
+        own_pieces = self.pieces[player - 1]
+        other_pieces = self.pieces[2 - player]
+        own_stacks = self.player_stacks[player - 1]
+        other_stacks = self.player_stacks[2 - player]
+        own_slot = self.num_sizes - max(own_stacks)
+        other_slot = self.num_sizes - max(other_stacks)
+        own_top = 0
+        other_top = 0
+        covered = 0
+        for slot in range(self.num_sizes):
+            own_slot_top = own_pieces[slot] & ~covered
+            other_slot_top = other_pieces[slot] & ~covered
+            if slot > own_slot and other_slot_top:
+                score += self.own_gobble_weight * bin(other_slot_top).count("1")
+            if slot > other_slot and own_slot_top:
+                score += self.other_gobble_weight * bin(own_slot_top).count("1")
+            own_top |= own_slot_top
+            other_top |= other_slot_top
+            covered |= own_pieces[slot] | other_pieces[slot]
+        stack_weights = self.stack_weights
+        for height in own_stacks:
+            score += stack_weights[height]
+        for height in other_stacks:
+            score -= stack_weights[height]
+        center = self.geo.center_mask
+        score += self.center_weight * (bin(own_top & center).count("1")
+                                       - bin(other_top & center).count("1"))
+        if self.eval_noise and self.noise:
+            score += self.random.randrange(self.eval_noise)
+        limit = self.huge_score - 1
+        return max(-limit, min(limit, score))
+
+    def feature_batch(self, player, encoded):
+        # The features of many positions at once, for 'player', who has just
+        # moved, given as rows of bitboards in the layout of encode_children.
+        # Returns a NumPy array with the eval_features of each position as a
+        # row, and an array of the result of each position: 1 if the player
+        # has a full line, -1 if the opponent has (checked first), else 0.
+        count = len(encoded)
+        full = self.board_size
+        num_sizes = self.num_sizes
+        own = player - 1
+        other = 2 - player
+
+        def popcounts(masks):
+            return numpy.unpackbits(masks.astype("<u8").view(numpy.uint8).reshape(count, 8),
+                                    axis=1).sum(axis=1).astype(numpy.int64)
+
+        # Visible pieces of each player and slot, and their line counts
+        tops = numpy.zeros((2, num_sizes, count), dtype=numpy.uint64)
+        covered = numpy.zeros(count, dtype=numpy.uint64)
+        for slot in range(num_sizes):
+            for owner in range(2):
+                tops[owner, slot] = encoded[:, owner * num_sizes + slot] & ~covered
+            covered |= encoded[:, slot] | encoded[:, num_sizes + slot]
+        top = numpy.bitwise_or.reduce(tops, axis=1)
+        visible = numpy.unpackbits(numpy.stack([ top[0], top[1] ], axis=1).astype("<u8")
+                                   .view(numpy.uint8).reshape(count, 2, 8),
+                                   axis=2, bitorder="little")[:, :, :self.geo.num_squares]
+        counts = (visible.astype(numpy.float32) @ self.geo.line_matrix).astype(numpy.int64)
+        own_counts = counts[:, own]
+        other_counts = counts[:, other]
+        results = numpy.where((other_counts == full).any(axis=1), -1,
+                              numpy.where((own_counts == full).any(axis=1), 1, 0))
+
+        columns = []
+        for count_lines, blocker in ((own_counts, other_counts), (other_counts, own_counts)):
+            for pieces in range(1, full):
+                columns.append(((count_lines == pieces) & (blocker == 0)).sum(axis=1))
+
+        # Pieces of each size in the stacks: those not on the board
+        reserves = numpy.array([ [ self.num_stacks - popcounts(encoded[:, owner * num_sizes + slot])
+                                   for slot in range(num_sizes) ] for owner in range(2) ])
+        top_counts = numpy.array([ [ popcounts(tops[owner, slot]) for slot in range(num_sizes) ]
+                                   for owner in range(2) ])
+        slots = numpy.arange(num_sizes)[:, None]
+        for gobbler, target in ((own, other), (other, own)):
+            # Slot of the largest piece in the gobbler's stacks
+            in_stacks = reserves[gobbler] > 0
+            largest = numpy.where(in_stacks.any(axis=0), in_stacks.argmax(axis=0), num_sizes)
+            columns.append((top_counts[target] * (slots > largest)).sum(axis=0))
+        for slot in range(num_sizes):
+            columns.append(reserves[own, slot] - reserves[other, slot])
+        center = numpy.uint64(self.geo.center_mask)
+        columns.append(popcounts(top[own] & center) - popcounts(top[other] & center))
+        return numpy.stack(columns, axis=1), results
+
+    def encode_children(self, player, moves):
+        # Bitboards of the position after each of 'moves' by 'player', as a
+        # NumPy array with one row per move, holding player 1's masks from
+        # slot 0 (the largest pieces) down, then player 2's
+        rows = []
+        for m in moves:
+            undo = self.make_move(player, m[0], m[1])
+            rows.append(self.pieces[0] + self.pieces[1])
+            self.undo_move(undo)
+        return numpy.array(rows, dtype=numpy.uint64).reshape(len(rows), 2 * self.num_sizes)
+
+    def evaluate_batch(self, player, encoded):
+        # Score many positions at once for 'player', who has just moved,
+        # given as rows of bitboards in the layout of encode_children, e.g. all
+        # the children of a position or a whole search frontier. Returns the
+        # list of scores that evaluate_board would give each position with
+        # noise off: the batch evaluator draws no random numbers, so quiet
+        # positions score 0 and the game's generator is left alone.
+        count = len(encoded)
+        self.evaluations += count
+        if self.weights is not None:
+            return self.evaluate_batch_weighted(player, encoded)
+        full = self.board_size
+        threat = full - 1
+        huge = self.huge_score
+        big = self.big_score
+
+        # Visible pieces, as in get_top_masks but for every position at once,
+        # unpacked to a (positions, 2, squares) array of 0/1 flags
+        x_top = numpy.zeros(count, dtype=numpy.uint64)
+        o_top = numpy.zeros(count, dtype=numpy.uint64)
+        covered = numpy.zeros(count, dtype=numpy.uint64)
+        for slot in range(self.num_sizes):
+            x_pieces = encoded[:, slot]
+            o_pieces = encoded[:, self.num_sizes + slot]
+            x_top |= x_pieces & ~covered
+            o_top |= o_pieces & ~covered
+            covered |= x_pieces | o_pieces
+        tops = numpy.stack([ x_top, o_top ], axis=1).astype("<u8").view(numpy.uint8)
+        visible = numpy.unpackbits(tops.reshape(count, 2, 8), axis=2,
+                                   bitorder="little")[:, :, :self.geo.num_squares]
+
+        # Line sums: the number of squares of each line owned by each player
+        counts = (visible.astype(numpy.float32) @ self.geo.line_matrix).astype(numpy.int32)
+        player_counts = counts[:, player - 1]
+        other_counts = counts[:, 2 - player]
+        empty_counts = full - player_counts - other_counts
+        positions = numpy.arange(count)
+
+        # Rows and columns: the first full line decides the score, checking
+        # the other player first. Otherwise the last line with a threat, all
+        # but one square of one player's and the other square empty, sets it.
+        diag1 = 2 * full
+        diag2 = diag1 + 1
+        player_lines = player_counts[:, :diag1]
+        other_lines = other_counts[:, :diag1]
+        other_full = other_lines == full
+        any_full = other_full | (player_lines == full)
+        first_full = any_full.argmax(axis=1)
+        full_scores = numpy.where(other_full[positions, first_full], -huge, huge)
+        open_lines = empty_counts[:, :diag1] == 1
+        threat_scores = numpy.select([ (other_lines == threat) & open_lines,
+                                       (player_lines == threat) & open_lines ],
+                                     [ -big, big ], default=0)
+        threatened = threat_scores != 0
+        last_threat = diag1 - 1 - threatened[:, ::-1].argmax(axis=1)
+        line_scores = numpy.where(threatened.any(axis=1), threat_scores[positions, last_threat], 0)
+
+        # Finally the diagonals, in the order evaluate_board checks them
+        player1 = player_counts[:, diag1]
+        player2 = player_counts[:, diag2]
+        other1 = other_counts[:, diag1]
+        other2 = other_counts[:, diag2]
+        scores = numpy.select([ (other1 == full) | (other2 == full),
+                                (player1 == full) | (player2 == full),
+                                (other1 == threat) & (player1 == 0),
+                                (other2 == threat) & (player2 == 0),
+                                (player1 == threat) & (other1 == 0),
+                                (player2 == threat) & (other2 == 0) ],
+                              [ -huge, huge, -huge, -huge, huge, huge ], default=line_scores)
+        scores = numpy.where(any_full.any(axis=1), full_scores, scores)
+        return scores.tolist()
+
+    def evaluate_batch_weighted(self, player, encoded):
+        # evaluate_batch for the parameterized evaluation, without its noise
+        features, results = self.feature_batch(player, encoded)
+        scores = features @ numpy.array(self.weights, dtype=numpy.int64)
+        undecided = results == 0
+        limit = self.huge_score - 1
+        scores = numpy.where(undecided, numpy.clip(scores, -limit, limit), results * self.huge_score)
+        return scores.tolist()
 
     def choose_best(self, player, moves):
+        # Try each move on the shared board and undo it after scoring
         for m in moves:
-            move = m[0]
-            dest = m[1]
-            tmp_board = copy.deepcopy(self.board)
-            tmp_stacks = copy.deepcopy(self.player_stacks)
-            tmp_board = self.do_move(tmp_board, tmp_stacks, player, move, dest)
-            m[2] = self.evaluate_board(player, tmp_board)
+            self.moves_made += 1
+            undo = self.make_move(player, m[0], m[1])
+            m[2] = self.evaluate_board(player)
+            self.undo_move(undo)
+        # Moving back into a position seen before in the game leads towards a
+        # draw by repetition, so it scores as a draw. Only moves of pieces on
+        # the board can repeat a position.
+        if self.position_counts:
+            side_key = self.geo.side_keys[2 - player]
+            for m in moves:
+                if len(m[0]) == 2:
+                    undo = self.make_move(player, m[0], m[1])
+                    if (self.hash ^ side_key) in self.position_counts and abs(m[2]) < self.huge_score:
+                        m[2] = 0
+                    self.undo_move(undo)
         moves = sorted(moves, key=itemgetter(2), reverse=True)
         #print(f"cb: {moves}")
 
         return moves[0]
 
+    def search_move(self, player, moves=None, think_ms=None):
+        # Iterative deepening alpha-beta search. Each completed depth sorts
+        # the root moves best first for the next one, and the best move from
+        # the last completed depth is returned when think_ms (by default
+        # self.think_ms) runs out. Only 'moves' are searched at the root, if
+        # given.
+        self.deadline = time.perf_counter() + (think_ms or self.think_ms) / 1000
+        self.reset_stats()
+        self.search_depth = 0
+        self.depth_results = []
+        self.tt.new_search()
+        if moves is None:
+            moves = self.get_legal_moves(player, unique=True)
+        if not moves:
+            return None
+        best = moves[0]
+        # Positions on the current search line, from the root down
+        self.path_keys = { self.hash ^ self.geo.side_keys[player - 1] }
+
+        for depth in range(1, self.max_depth + 1):
+            try:
+                self.search_root(player, moves, depth)
+            except SearchTimeout:
+                break
+            moves.sort(key=itemgetter(2), reverse=True)
+            best = list(moves[0])
+            self.search_depth = depth
+            self.depth_results.append([ list(m) for m in moves ])
+            if self.depth_callback:
+                self.depth_callback(depth, best)
+            # Stop early once a forced win or loss has been found
+            if abs(best[2]) > self.huge_score:
+                break
+
+        return best
+
+    def parallel_search_move(self, player, think_ms=None):
+        # Split the root moves between self.workers processes, each running
+        # its own iterative deepening search for think_ms (by default
+        # self.think_ms). Scores are
+        # only comparable at the same depth, so the move is chosen from the
+        # deepest depth that every worker completed. A worker that stopped
+        # early on a forced win or loss has its last scores carried deeper.
+        moves = self.get_legal_moves(player, unique=True)
+        if not moves:
+            return None
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, initializer=init_search_worker,
+                                             initargs=(self.tt_mb, self.board_size,
+                                                       self.num_stacks, self.num_sizes,
+                                                       self.eval_weights))
+
+        start = time.perf_counter()
+        # Each worker's random scores are seeded from this game's generator,
+        # so a seeded game plays the same whichever worker gets which moves
+        history = list(self.position_counts)
+        tasks = [ (self.board, self.player_stacks, player, moves[i::self.workers],
+                   think_ms or self.think_ms, self.max_depth, self.noise,
+                   self.random.getrandbits(64), history)
+                  for i in range(min(self.workers, len(moves))) ]
+        results = self.pool.map(search_root_moves, tasks)
+        elapsed = time.perf_counter() - start
+        for _, _, _, counters in results:
+            self.add_counters(counters)
+
+        depth = min(len(depth_results) if abs(depth_results[-1][0][2]) <= self.huge_score
+                    else self.max_depth
+                    for depth_results, _, _, _ in results)
+        candidates = []
+        for depth_results, _, _, _ in results:
+            candidates.extend(depth_results[min(depth, len(depth_results)) - 1])
+        best = max(candidates, key=itemgetter(2))
+
+        # The utilization is the number of CPU seconds of search done by the
+        # workers for each second of wall-clock time. It is not a speedup:
+        # it is near the number of workers even when the split search
+        # reaches no deeper than a single process would. bench.py measures
+        # the speedup against a single process searching to the same depth.
+        nodes = sum(result[1] for result in results)
+        search_seconds = sum(result[2] for result in results)
+        self.search_depth = depth
+        self.nodes = nodes
+        self.parallel_stats = {
+            "workers": len(tasks),
+            "depth": depth,
+            "nodes": nodes,
+            "seconds": elapsed,
+            "nodes_per_second": nodes / elapsed,
+            "utilization": search_seconds / elapsed,
+        }
+        return best
+
+    def close(self):
+        # Shut down the worker processes of the parallel search
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+        if self.mcts is not None:
+            self.mcts.close()
+
+    def reset_stats(self):
+        self.nodes = 0
+        self.moves_made = 0
+        self.moves_generated = 0
+        self.evaluations = 0
+        self.tt_hits = 0
+        self.tt_misses = 0
+        self.cutoffs = 0
+        if self.timings is not None:
+            self.timings = dict.fromkeys(self.timings, 0.0)
+
+    def counters(self):
+        # The work counters, as a dict for passing between processes
+        return {
+            "nodes": self.nodes,
+            "moves": self.moves_made,
+            "moves_generated": self.moves_generated,
+            "evaluations": self.evaluations,
+            "tt_hits": self.tt_hits,
+            "tt_misses": self.tt_misses,
+            "cutoffs": self.cutoffs,
+        }
+
+    def add_counters(self, counters):
+        # Add the work counters of a parallel search worker to ours. The
+        # worker's nodes are counted separately by parallel_search_move.
+        self.moves_made += counters["moves"]
+        self.moves_generated += counters["moves_generated"]
+        self.evaluations += counters["evaluations"]
+        self.tt_hits += counters["tt_hits"]
+        self.tt_misses += counters["tt_misses"]
+        self.cutoffs += counters["cutoffs"]
+
+    def enable_timings(self):
+        # Measure the time spent in the hot paths by shadowing the methods
+        # with timing wrappers on this instance only, so that games without a
+        # trace file pay nothing for it. Each bucket gets exclusive time: the
+        # make_move and undo_move calls made inside generate_moves count as
+        # make_move only, so the buckets never add up to more than the total.
+        self.timings = { "movegen": 0.0, "make_move": 0.0, "evaluate": 0.0 }
+        clock = time.perf_counter
+        # Time spent in timed calls nested in each timed call under way
+        nested = []
+
+        def run(key, call):
+            nested.append(0.0)
+            start = clock()
+            try:
+                return call()
+            finally:
+                elapsed = clock() - start
+                self.timings[key] += elapsed - nested.pop()
+                if nested:
+                    nested[-1] += elapsed
+
+        def timed(method, key):
+            def wrapper(*args, **kwargs):
+                return run(key, lambda: method(*args, **kwargs))
+            return wrapper
+
+        def timed_generator(method, key):
+            # Only the time spent producing each move counts, not the time
+            # the caller spends searching it
+            def wrapper(*args, **kwargs):
+                moves = method(*args, **kwargs)
+                while True:
+                    try:
+                        move = run(key, lambda: next(moves))
+                    except StopIteration:
+                        return
+                    yield move
+            return wrapper
+
+        self.get_legal_moves = timed(self.get_legal_moves, "movegen")
+        self.generate_moves = timed_generator(self.generate_moves, "movegen")
+        self.make_move = timed(self.make_move, "make_move")
+        self.undo_move = timed(self.undo_move, "make_move")
+        self.evaluate_board = timed(self.evaluate_board, "evaluate")
+
+    def search_root(self, player, moves, depth):
+        alpha = -self.win_score
+        beta = self.win_score
+        for m in moves:
+            m[2] = self.search_child(player, m[0], m[1], depth, alpha, beta, 1)
+            if m[2] > alpha:
+                alpha = m[2]
+
+    def search_child(self, player, move, dest, depth, alpha, beta, ply):
+        # Score 'move' for 'player' by making it, checking for a finished game
+        # and searching the opponent's replies, always undoing the move, even
+        # when the search is interrupted by SearchTimeout.
+        self.moves_made += 1
+        undo = self.make_move(player, move, dest)
+        try:
+            winner = self.is_a_winner(player)
+            if winner == player:
+                return self.win_score - ply
+            elif winner:
+                return ply - self.win_score
+            return -self.negamax(3 - player, depth - 1, -beta, -alpha, ply + 1)
+        finally:
+            self.undo_move(undo)
+
+    def negamax(self, player, depth, alpha, beta, ply):
+        # Return the score of the position for 'player', who is to move
+        self.nodes += 1
+        # Depth 1 always completes, so there is always a move to return
+        if not self.nodes & 255 and self.search_depth and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        key = self.hash ^ self.geo.side_keys[player - 1]
+        # A position met before, in the game or on this search line, is a
+        # draw, as the side that repeated it can go on repeating it
+        if key in self.path_keys or key in self.position_counts:
+            return 0
+        if depth == 0:
+            # evaluate_board scores a position for the player who just moved
+            return -self.evaluate_board(3 - player)
+
+        entry = self.tt.probe(key)
+        tt_move = None
+        if entry:
+            self.tt_hits += 1
+            tt_move = entry[4]
+            if entry[1] >= depth:
+                score = self.score_from_tt(entry[2], ply)
+                bound = entry[3]
+                if bound == EXACT:
+                    return score
+                elif bound == LOWER and score > alpha:
+                    alpha = score
+                elif bound == UPPER and score < beta:
+                    beta = score
+                if alpha >= beta:
+                    return score
+        else:
+            self.tt_misses += 1
+
+        # Search the best move from the table first, then the rest in stages
+        if tt_move and not self.is_legal_move(player, tt_move[0], tt_move[1]):
+            tt_move = None
+        moves = self.generate_moves(player)
+        if tt_move:
+            moves = itertools.chain([ tt_move ], (m for m in moves if m != tt_move))
+
+        alpha_orig = alpha
+        best = -self.win_score
+        best_move = None
+        self.path_keys.add(key)
+        try:
+            for move, dest in moves:
+                score = self.search_child(player, move, dest, depth, alpha, beta, ply)
+                if score > best:
+                    best = score
+                    best_move = (move, dest)
+                    # Nothing beats winning with this move
+                    if best >= self.win_score - ply:
+                        break
+                    if best > alpha:
+                        alpha = best
+                        if alpha >= beta:
+                            self.cutoffs += 1
+                            break
+        finally:
+            self.path_keys.discard(key)
+        if not best_move:
+            return 0
+
+        if best <= alpha_orig:
+            bound = UPPER
+        elif best >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.tt.store(key, depth, self.score_to_tt(best, ply), bound, best_move)
+        return best
+
+    def score_to_tt(self, score, ply):
+        # Wins and losses are stored as distances from the stored position,
+        # not from the root, so they stay correct when reached by another path
+        if score > self.huge_score:
+            return score + ply
+        elif score < -self.huge_score:
+            return score - ply
+        return score
+
+    def score_from_tt(self, score, ply):
+        if score > self.huge_score:
+            return score - ply
+        elif score < -self.huge_score:
+            return score + ply
+        return score
+
+    def choose_move(self, player):
+        # Pick the computer's move, as a [move, dest, score] list, without
+        # printing anything. Returns None if the player has no legal move.
+        # A summary of the work done is left in self.stats, and appended to
+        # the trace file if there is one.
+        self.reset_stats()
+        self.search_depth = 0
+        start = time.perf_counter()
+        move, source = self.find_move(player)
+        seconds = time.perf_counter() - start
+
+        self.stats = {
+            "player": player,
+            "move": move[0] if move else None,
+            "dest": move[1] if move else None,
+            "score": move[2] if move else None,
+            "source": source,
+            "depth": self.search_depth,
+            **self.counters(),
+            "seconds": seconds,
+            "nodes_per_second": self.nodes / seconds if seconds else 0,
+        }
+        if source == "parallel":
+            self.stats["workers"] = self.parallel_stats["workers"]
+            self.stats["utilization"] = self.parallel_stats["utilization"]
+        elif source == "mcts":
+            self.stats["mcts"] = self.mcts.stats
+        if self.pns and self.pns.stats:
+            self.stats["pns"] = self.pns.stats
+        if self.timings is not None:
+            self.stats["timings"] = dict(self.timings)
+        if self.trace_file is not None:
+            self.trace_file.write(json.dumps(self.stats) + "\n")
+            self.trace_file.flush()
+        return move
+
+    def find_move(self, player):
+        # Return the computer's move and where it came from: the opening
+        # book, a proof-number search, a Monte Carlo tree search, an
+        # alpha-beta search, a parallel alpha-beta search or one move of
+        # lookahead
+        if self.book:
+            move = self.book_move(player)
+            if move:
+                return move, "book"
+        think_ms = self.think_ms
+        if self.pns:
+            self.pns.stats = {}
+            # Forced wins are only worth looking for once the player to move
+            # holds or faces a threat: a line one piece short of complete
+            # with none of the other side's pieces showing in it. The search
+            # gets a share of the time for the move, leaving the rest to the
+            # search that follows if it proves nothing.
+            threat = self.board_size - 1
+            if any((own == threat and not other) or (other == threat and not own)
+                   for own, other in zip(self.line_counts[0], self.line_counts[1])):
+                deadline = None
+                if think_ms and think_ms != float("inf"):
+                    start = time.perf_counter()
+                    deadline = start + self.pns_share * think_ms / 1000
+                move = self.pns.choose_move(self, player, deadline)
+                if move:
+                    return move, "pns"
+                if deadline is not None:
+                    think_ms = max(1, think_ms - 1000 * (time.perf_counter() - start))
+        if self.mcts:
+            return self.mcts.choose_move(self, player), "mcts"
+        if self.think_ms and self.workers > 1:
+            return self.parallel_search_move(player, think_ms), "parallel"
+        elif self.think_ms:
+            return self.search_move(player, think_ms=think_ms), "search"
+        moves = self.get_legal_moves(player, unique=True)
+        if not moves:
+            return None, "lookahead"
+        return self.choose_best(player, moves), "lookahead"
+
+    def book_move(self, player):
+        # Look the position up in the opening book, which is keyed by the
+        # canonical hash, and map the stored move back onto this board
+        hash, sym = self.canonical_hash()
+        entry = self.book.lookup(hash ^ self.geo.side_keys[player - 1])
+        if not entry:
+            return None
+        move, dest, score = entry
+        move, dest = self.geo.transform_move(self.geo.sym_inverse[sym], move, dest)
+        if not self.is_legal_move(player, move, dest):
+            return None
+        return [ move, dest, score ]
+
     def generate_move(self, player):
-        moves = self.get_legal_moves(player)
-        move = self.choose_best(player, moves)
-        move[0] = move[0][::-1]
-        move[1] = move[1][::-1]
-        print(f"Computer player {player} move is: {move}")
-        move[0] = move[0][::-1]
-        move[1] = move[1][::-1]
+        move = self.choose_move(player)
+        shown = [ flip_notation(move[0]), flip_notation(move[1]), move[2] ]
+        print(f"Computer player {player} move is: {shown}")
         return move[0], move[1]
 
     def get_move(self, player):
         while True:
-            move = input("Enter piece size (1-4) to add or location (XY) to move: ")
-            move = move[::-1]
+            move = input(f"Enter piece size (1-{self.num_sizes}) to add or location (XY) to move: ")
+            move = flip_notation(move)
             size = self.check_from(player, move)
             if not size:
                 continue
             dest = input("Enter destination location (XY): ")
-            dest = dest[::-1]
+            dest = flip_notation(dest)
             if self.check_to(player, size, dest):
                 return move, dest
             print()
@@ -524,28 +1769,28 @@ class Gobblet:
             # empty piece stack position in board location 'dest'
             move = int(move)
             found = -1
-            for stack in range(3):
+            for stack in range(self.num_stacks):
                 if stacks[player - 1][stack] == move:
                     found = stack
                     break
             if found == -1:
                 print("Error: player has no usable piece of that size")
             else:
-                if board[dx][dy][4 - move] != 0:
+                if board[dx][dy][self.num_sizes - move] != 0:
                     print("Error: destination already has a piece of that size")
                     return False
 
                 # Sizes are 4, 3, 2, 1, so decrement size in stack we took from
                 stacks[player - 1][stack] -= 1
                 # Now add player's piece to destination
-                board[dx][dy][4 - move] = player
+                board[dx][dy][self.num_sizes - move] = player
                 return board
         else:
             # Remove piece from board stack in location 'move' and place on first
             # empty piece stack position in board location 'dest'
             x = ord(move[0]) - ord("A")
             y = ord(move[1]) - ord("A")
-            for size in range(4):
+            for size in range(self.num_sizes):
                 if board[x][y][size] == 0:
                     continue
                 board[x][y][size] = 0
@@ -554,6 +1799,81 @@ class Gobblet:
 
         return board
 
+    def make_move(self, player, move, dest):
+        # Reversible counterpart of do_move, for moves already known to be
+        # legal (validated by check_from/check_to or from get_legal_moves).
+        # Updates self.board, self.player_stacks, the bitboards and the hash
+        # in place and returns an undo record (player, slot, stack, src, dest,
+        # hash), where stack is the player stack a new piece came from (or -1),
+        # src is the source square of a moved piece (or -1) and hash is the
+        # hash before the move.
+        geo = self.geo
+        dest_sq = geo.square_index[dest]
+        pieces = self.pieces[player - 1]
+        keys = geo.piece_keys[player - 1]
+        old_hash = self.hash
+
+        if len(move) == 1:
+            size = int(move)
+            slot = self.num_sizes - size
+            stacks = self.player_stacks[player - 1]
+            stack = stacks.index(size)
+            stacks[stack] -= 1
+            stack_keys = geo.stack_keys[player - 1][stack]
+            self.hash ^= stack_keys[size] ^ stack_keys[size - 1]
+            src_sq = -1
+        else:
+            src_sq = geo.square_index[move]
+            row, column = geo.square_coords[src_sq]
+            square = self.board[row][column]
+            slot = 0
+            while not square[slot]:
+                slot += 1
+            square[slot] = 0
+            pieces[slot] ^= 1 << src_sq
+            self.hash ^= keys[slot][src_sq]
+            stack = -1
+            # Uncover the piece below, if any
+            below = self.get_outermost(square) or 0
+            self.top_owner[src_sq] = below
+            if below != player:
+                self.update_lines(src_sq, player, below)
+
+        row, column = geo.square_coords[dest_sq]
+        self.board[row][column][slot] = player
+        pieces[slot] |= 1 << dest_sq
+        self.hash ^= keys[slot][dest_sq]
+        covered = self.top_owner[dest_sq]
+        self.top_owner[dest_sq] = player
+        if covered != player:
+            self.update_lines(dest_sq, covered, player)
+        return (player, slot, stack, src_sq, dest_sq, old_hash)
+
+    def undo_move(self, undo):
+        # Restore the board, stacks and bitboards to their state before the
+        # make_move call that returned 'undo'
+        player, slot, stack, src_sq, dest_sq, self.hash = undo
+        pieces = self.pieces[player - 1]
+
+        row, column = self.geo.square_coords[dest_sq]
+        square = self.board[row][column]
+        square[slot] = 0
+        pieces[slot] ^= 1 << dest_sq
+        uncovered = self.get_outermost(square) or 0
+        self.top_owner[dest_sq] = uncovered
+        if uncovered != player:
+            self.update_lines(dest_sq, player, uncovered)
+        if stack >= 0:
+            self.player_stacks[player - 1][stack] += 1
+        else:
+            row, column = self.geo.square_coords[src_sq]
+            self.board[row][column][slot] = player
+            pieces[slot] |= 1 << src_sq
+            covered = self.top_owner[src_sq]
+            self.top_owner[src_sq] = player
+            if covered != player:
+                self.update_lines(src_sq, covered, player)
+
     def get_computer_players(self):
         while True:
             num_humans = input("How many human players? (0-2) ")
@@ -569,25 +1889,107 @@ class Gobblet:
                 self.computer_players = [ False, True ]
             case 2:
                 self.computer_players = [ False, False ]
+        if nh == 2:
+            return
+
+        while True:
+            engine = input("Computer engine: lookahead or Monte Carlo tree search? (l/m) ")
+            if engine in ("l", "m"):
+                break
+        if engine == "m":
+            # Imported here, as mcts.py imports this module
+            from mcts import MCTS
+            self.mcts = MCTS(think_ms=2000, playout="heuristic")
+
+    def play_headless(self, max_moves=200):
+        # Play a computer-vs-computer game from the current position with no
+        # terminal I/O. Returns (winner, moves), where winner is 0 if the game
+        # was drawn by repetition or by being stuck, was not decided within
+        # max_moves moves or a player could not move, and moves is the list of
+        # (move, dest) pairs played. self.end_reason tells which.
+        player = 1
+        moves = []
+        self.reset_history(player)
+        self.end_reason = "move cap"
+        while self.num_moves < max_moves:
+            move = self.choose_move(player)
+            if not move:
+                self.end_reason = "no moves"
+                break
+            self.num_moves += 1
+            self.make_move(player, move[0], move[1])
+            moves.append((move[0], move[1]))
+            winner = self.is_a_winner(player)
+            if winner:
+                self.end_reason = "win"
+                return winner, moves
+            reason = self.record_move(player, move[0])
+            if reason:
+                self.end_reason = reason
+                break
+            player = 3 - player
+        return 0, moves
 
     def play(self):
         self.get_computer_players()
         player = 1
+        self.reset_history(player)
         self.show_board()
         while True:
+            if self.max_moves and self.num_moves >= self.max_moves:
+                self.end_reason = "move cap"
+                print(f"The game is drawn after {self.num_moves} moves")
+                break
             self.num_moves += 1
             print(f"Player {player} ({self.player_chars[player - 1]}) to move")
             if self.computer_players[player - 1]:
                 move, dest = self.generate_move(player)
             else:
                 move, dest = self.get_move(player)
-            if not self.do_move(self.board, self.player_stacks, player, move, dest):
-                print()
-                continue
+            self.make_move(player, move, dest)
             self.show_board()
             if self.game_over(player):
+                self.end_reason = "win"
+                break
+            reason = self.record_move(player, move)
+            if reason == "repetition":
+                self.end_reason = reason
+                print(f"The game is drawn by repetition in {self.num_moves} moves")
+                break
+            elif reason == "stuck":
+                self.end_reason = reason
+                print(f"The game is drawn: no new piece played for {self.stuck_moves} moves")
                 break
             player = 3 - player
 
-gobblet = Gobblet()
-gobblet.play()
+# Each parallel search worker process keeps one Gobblet, so that its
+# transposition table stays warm from one move to the next
+search_worker = None
+
+def init_search_worker(tt_mb, board_size, num_stacks, num_sizes, weights=None):
+    global search_worker
+    search_worker = Gobblet(tt_mb=tt_mb, board_size=board_size, num_stacks=num_stacks,
+                            num_sizes=num_sizes, weights=weights)
+
+def search_root_moves(task):
+    # Search some of the root moves of a position in a worker process and
+    # return the scores after each completed depth, the number of nodes
+    # searched, the CPU time taken and the work counters
+    board, stacks, player, moves, think_ms, max_depth, noise, seed, history = task
+    start = time.process_time()
+    search_worker.set_position(board, stacks)
+    search_worker.position_counts = dict.fromkeys(history, 1)
+    search_worker.think_ms = think_ms
+    search_worker.max_depth = max_depth
+    search_worker.noise = noise
+    search_worker.random.seed(seed)
+    search_worker.search_move(player, moves)
+    return (search_worker.depth_results, search_worker.nodes, time.process_time() - start,
+            search_worker.counters())
+
+def main():
+    gobblet = Gobblet()
+    gobblet.play()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+#!/usr/local/bin/python3
+
+"""
+Monte Carlo tree search (UCT) computer player for Gobblet.
+
+Instead of scoring positions with evaluate_board, the tree search plays fast
+games to the end from each new position (playouts) and steers towards the
+moves that win most of them, trading off trying the best moves so far against
+exploring the others with the UCB1 formula. Strength grows with the number of
+playouts, so the player can be given an iteration budget, a time budget, or
+both, and the search can be spread over worker processes.
+
+Playouts are either purely random ("random"), or take a winning move whenever
+the side to move has one ("heuristic"), which avoids most of the blunders that
+make random games a poor guide. A playout that goes on for more than
+max_playout_moves moves, or reaches a position where the side to move has no
+legal move, counts as a draw.
+
+The game's draw rules are kept too. A position that was already reached in
+the game (Gobblet.position_counts) or earlier on the same line of play, in
+the tree or in the playout, is a draw, as negamax scores it. A line with
+Gobblet.stuck_moves moves in a row of pieces already on the board, counting
+from Gobblet.quiet_moves, is a draw too, which negamax does not check, as
+its lines are far shorter than stuck_moves.
+
+The tree is kept between moves. If the position to search was already in the
+tree, one or two moves on from the last search, its subtree becomes the new
+root and its playouts are reused.
+
+Usage from Python:
+
+  gobblet = Gobblet(mcts=MCTS(think_ms=2000, playout="heuristic"))
+"""
+
+import itertools
+import math
+import multiprocessing
+import time
+
+from gobblet import Gobblet
+
+class Node:
+    # A position in the tree, reached by 'move' (a (move, dest) pair) of
+    # 'player'. 'wins' counts the playouts through it won by 'player', with
+    # draws as half a win. 'untried' is None until the node is first expanded,
+    # then the list of its moves that have no child node yet. 'winner' is
+    # set if the move ended the game.
+    __slots__ = ("move", "player", "parent", "children", "untried", "visits", "wins",
+                 "winner", "key")
+
+    def __init__(self, move, player, parent, key, winner=0):
+        self.move = move
+        self.player = player
+        self.parent = parent
+        self.children = []
+        self.untried = None
+        self.visits = 0
+        self.wins = 0.0
+        self.winner = winner
+        self.key = key
+
+class MCTS:
+
+    def __init__(self, iterations=None, think_ms=None, playout="random", exploration=1.4,
+                 max_playout_moves=60, workers=1):
+        if playout not in ("random", "heuristic"):
+            raise ValueError("playout must be 'random' or 'heuristic'")
+        # Without any budget, search a fixed number of iterations
+        if iterations is None and think_ms is None:
+            iterations = 1000
+        self.iterations = iterations
+        self.think_ms = think_ms
+        self.playout = playout
+        self.exploration = exploration
+        self.max_playout_moves = max_playout_moves
+        # With more than one worker, each of 'workers' trees is grown in a
+        # worker process for the whole budget, and their root statistics
+        # are added up
+        self.workers = workers
+        self.pool = None
+        self.root = None
+        # Summary of the last search
+        self.stats = {}
+
+    def settings(self):
+        # Arguments for an equivalent single-process MCTS in a worker
+        return {
+            "iterations": self.iterations,
+            "think_ms": self.think_ms,
+            "playout": self.playout,
+            "exploration": self.exploration,
+            "max_playout_moves": self.max_playout_moves,
+        }
+
+    def choose_move(self, gobblet, player):
+        # Return a winning move if one was found, or else the move with the
+        # most playouts, as a [move, dest, score] list where score is the
+        # per-mille share of its playouts won, or None if 'player' has no
+        # legal move
+        if self.workers > 1:
+            root_moves = self.parallel_search(gobblet, player)
+        else:
+            self.search(gobblet, player)
+            root_moves = root_statistics(self.root)
+        if not root_moves:
+            return None
+        move, visits, wins, won = max(root_moves, key=lambda root_move: (root_move[3], root_move[1]))
+        return [ move[0], move[1], int(1000 * wins / visits) ]
+
+    def search(self, gobblet, player):
+        # Grow the tree for the position of 'gobblet' with 'player' to move
+        # until the iteration or time budget runs out
+        start = time.perf_counter()
+        deadline = start + self.think_ms / 1000 if self.think_ms else None
+        key = gobblet.hash ^ gobblet.geo.side_keys[player - 1]
+        root = self.find_root(key)
+        reused = root is not None
+        if root is None:
+            root = Node(None, 3 - player, None, key)
+        root.parent = None
+        self.root = root
+        reused_visits = root.visits
+
+        iterations = 0
+        while True:
+            if self.iterations is not None and iterations >= self.iterations:
+                break
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+            self.iterate(gobblet, player)
+            iterations += 1
+            # Nothing to search with only one move, and nothing beats a
+            # move that wins on the spot
+            if root.untried == [] and len(root.children) <= 1:
+                break
+            if root.children and root.children[-1].winner == player:
+                break
+
+        seconds = time.perf_counter() - start
+        self.stats = {
+            "iterations": iterations,
+            "reused_visits": reused_visits if reused else 0,
+            "root_visits": root.visits,
+            "seconds": seconds,
+            "playouts_per_second": iterations / seconds if seconds else 0,
+        }
+
+    def find_root(self, key):
+        # Look for the position in the tree, up to 2 moves on from the last
+        # root searched
+        if self.root is None:
+            return None
+        if self.root.key == key:
+            return self.root
+        for child in self.root.children:
+            if child.key == key:
+                return child
+            for grandchild in child.children:
+                if grandchild.key == key:
+                    return grandchild
+        return None
+
+    def iterate(self, gobblet, player):
+        # One round of selection, expansion, playout and backpropagation,
+        # leaving the board as it was found
+        side_keys = gobblet.geo.side_keys
+        node = self.root
+        undos = []
+        # Positions of the game and of this line of play, and the moves in a
+        # row of board pieces, for the draw rules
+        seen = set(gobblet.position_counts)
+        seen.add(node.key)
+        quiet = gobblet.quiet_moves
+        drawn = False
+        try:
+            # Selection: follow the best UCB1 child through fully expanded nodes
+            while node.untried == [] and node.children and not node.winner:
+                node = self.select_child(node)
+                undos.append(gobblet.make_move(node.player, node.move[0], node.move[1]))
+                drawn, quiet = self.is_drawn(gobblet, node.player, node.move[0], seen, quiet)
+                if drawn:
+                    break
+            player = 3 - node.player
+
+            # Expansion: add one untried move as a new node
+            if not node.winner and not drawn:
+                if node.untried is None:
+                    node.untried = [ (move, dest) for move, dest, _
+                                     in gobblet.get_legal_moves(player, unique=True) ]
+                    gobblet.random.shuffle(node.untried)
+                if node.untried:
+                    move = node.untried.pop()
+                    undos.append(gobblet.make_move(player, move[0], move[1]))
+                    child = Node(move, player, node, gobblet.hash ^ side_keys[2 - player],
+                                 gobblet.is_a_winner(player) or 0)
+                    node.children.append(child)
+                    node = child
+                    drawn, quiet = self.is_drawn(gobblet, player, move[0], seen, quiet)
+
+            # Playout
+            if node.winner:
+                winner = node.winner
+            elif drawn:
+                winner = 0
+            else:
+                winner = self.run_playout(gobblet, 3 - node.player, seen, quiet)
+        finally:
+            for undo in reversed(undos):
+                gobblet.undo_move(undo)
+
+        # Backpropagation
+        while node is not None:
+            node.visits += 1
+            if winner == node.player:
+                node.wins += 1
+            elif not winner:
+                node.wins += 0.5
+            node = node.parent
+
+    def select_child(self, node):
+        log_visits = math.log(node.visits)
+        exploration = self.exploration
+        return max(node.children, key=lambda child: child.wins / child.visits
+                   + exploration * math.sqrt(log_visits / child.visits))
+
+    def is_drawn(self, gobblet, player, move, seen, quiet):
+        # Whether the game is drawn after 'player' made 'move', given the
+        # positions 'seen' before it and 'quiet' moves of board pieces in a
+        # row, and the new count of those moves. The position is added to
+        # 'seen', which only grows during one iteration.
+        key = gobblet.hash ^ gobblet.geo.side_keys[2 - player]
+        quiet = 0 if len(move) == 1 else quiet + 1
+        if key in seen or (gobblet.stuck_moves and quiet >= gobblet.stuck_moves):
+            return True, quiet
+        seen.add(key)
+        return False, quiet
+
+    def run_playout(self, gobblet, player, seen, quiet):
+        # Play the game out from the position with 'player' to move, undo
+        # all the moves, and return the winner, or 0 for a draw
+        undos = []
+        winner = 0
+        try:
+            for _ in range(self.max_playout_moves):
+                move = self.playout_move(gobblet, player)
+                if move is None:
+                    break
+                undos.append(gobblet.make_move(player, move[0], move[1]))
+                winner = gobblet.is_a_winner(player)
+                if winner:
+                    break
+                drawn, quiet = self.is_drawn(gobblet, player, move[0], seen, quiet)
+                if drawn:
+                    break
+                player = 3 - player
+        finally:
+            for undo in reversed(undos):
+                gobblet.undo_move(undo)
+        return winner
+
+    def playout_move(self, gobblet, player):
+        if self.playout == "heuristic" and gobblet.board_size - 1 in gobblet.line_counts[player - 1]:
+            # generate_moves yields the moves onto the player's open lines
+            # first, so a winning move, if any, is among the first few
+            for move, dest in itertools.islice(gobblet.generate_moves(player), 8):
+                undo = gobblet.make_move(player, move, dest)
+                winner = gobblet.is_a_winner(player)
+                gobblet.undo_move(undo)
+                if winner == player:
+                    return move, dest
+        moves = gobblet.get_legal_moves(player)
+        if not moves:
+            return None
+        return gobblet.random.choice(moves)[:2]
+
+    def parallel_search(self, gobblet, player):
+        # Search the position in every worker process at once, and add up
+        # the playouts of each root move
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, initializer=init_mcts_worker,
+                                             initargs=(gobblet.board_size, gobblet.num_stacks,
+                                                       gobblet.num_sizes, self.settings()))
+        start = time.perf_counter()
+        # Each task grows the tree of its own index, whichever worker picks
+        # it up, so no tree is searched twice in one call
+        history = list(gobblet.position_counts)
+        tasks = [ (index, gobblet.board, gobblet.player_stacks, player,
+                   gobblet.random.getrandbits(64), history, gobblet.quiet_moves)
+                  for index in range(self.workers) ]
+        results = self.pool.map(search_task, tasks, chunksize=1)
+        seconds = time.perf_counter() - start
+
+        totals = {}
+        for root_moves, _ in results:
+            for move, visits, wins, won in root_moves:
+                total = totals.setdefault(move, [ 0, 0.0, False ])
+                total[0] += visits
+                total[1] += wins
+                total[2] = total[2] or won
+        iterations = sum(stats["iterations"] for _, stats in results)
+        self.stats = {
+            "iterations": iterations,
+            "reused_visits": sum(stats["reused_visits"] for _, stats in results),
+            "root_visits": sum(stats["root_visits"] for _, stats in results),
+            "seconds": seconds,
+            "playouts_per_second": iterations / seconds if seconds else 0,
+            "workers": self.workers,
+        }
+        return [ (move, visits, wins, won) for move, (visits, wins, won) in totals.items() ]
+
+    def close(self):
+        # Shut down the worker processes of the parallel search
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+def root_statistics(root):
+    # The playouts and wins of each move from the root, and whether it wins
+    # on the spot
+    return [ (child.move, child.visits, child.wins, child.winner == child.player)
+             for child in root.children ]
+
+# Each worker process keeps one Gobblet, and the last tree it grew for each
+# task index, so that a tree can be reused from one move to the next when
+# the same worker picks up its index again
+mcts_worker = None
+
+def init_mcts_worker(board_size, num_stacks, num_sizes, settings):
+    global mcts_worker
+    mcts_worker = (Gobblet(board_size=board_size, num_stacks=num_stacks, num_sizes=num_sizes),
+                   MCTS(**settings), {})
+
+def search_task(task):
+    # Grow the tree of a task index for a position and return the playouts
+    # and wins of each root move, with the search stats
+    index, board, stacks, player, seed, history, quiet_moves = task
+    gobblet, mcts, trees = mcts_worker
+    gobblet.set_position(board, stacks)
+    gobblet.position_counts = dict.fromkeys(history, 1)
+    gobblet.quiet_moves = quiet_moves
+    gobblet.random.seed(seed)
+    mcts.root = trees.get(index)
+    mcts.search(gobblet, player)
+    trees[index] = mcts.root
+    return root_statistics(mcts.root), mcts.stats
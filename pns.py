@@ -0,0 +1,264 @@
+#!/usr/local/bin/python3
+
+"""
+Proof-number search for forced wins in Gobblet.
+
+Proof-number search steers towards the moves that are easiest to prove or
+refute, instead of searching every move to a fixed depth. Each position has a
+proof number, the fewest unsolved positions that would have to turn out to be
+wins for the attacker to prove it a win, and a disproof number, the same for
+refuting it. Where the attacker is to move one winning move is enough, so the
+proof number is the least of its moves' and the disproof number their sum;
+where the defender is to move, it is the other way round.
+
+This is the depth-first variant (df-pn), which keeps the numbers of the
+positions searched in a transposition table rather than a tree, so positions
+reached by different move orders, which are common in Gobblet, are solved
+once. Written for the side to move, phi is its proof number (for the
+attacker) or disproof number (for the defender) and delta the other one, so
+a position's phi is the least delta of its moves and its delta the sum of
+their phis. A position is searched until its numbers reach thresholds set by
+its parent, always going into the move with the least delta, with a
+threshold of one more than the second least.
+
+This finds forced sequences such as double threats, or a gobble that uncovers
+a line (which is_a_winner credits to the opponent), with far fewer nodes than
+a full-width search, and proves them rather than just scoring them highly.
+Positions repeated on the line searched, or already met in the game,
+positions where the side to move has no legal move, and positions more than
+max_depth moves from the start of the search count as draws, so as not wins
+for the attacker. A disproof therefore shows there is no win within
+max_depth moves.
+
+Usage:
+
+  ./pns.py "X4,.,.,./.,X3,.,./.,.,X2,./O4,O3,O2,. 441/441 X"
+
+Usage from Python:
+
+  pns = ProofNumberSearch(max_nodes=100000)
+  result, line = pns.prove(gobblet, player)
+
+where result is "win" if player has a forced win, with line the moves of the
+win, "no win" if it does not, or "unknown" if the node budget or the deadline
+(a time.perf_counter() value, if given) ran out first.
+Gobblet(pns=ProofNumberSearch()) tries it before searching whenever either
+side has a line one piece short of complete with none of the other side's
+pieces showing in it, within a share of think_ms.
+"""
+
+import argparse
+import time
+
+from gobblet import Gobblet, flip_notation
+
+# Proof and disproof number of a solved position
+INFINITY = 1 << 40
+
+class NodeBudgetExceeded(Exception):
+    pass
+
+class ProofNumberSearch:
+
+    # The default node budget is for trying the search on a game move, at a
+    # few thousand nodes per second
+    def __init__(self, max_nodes=10000, max_depth=60):
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.nodes = 0
+        self.deadline = None
+        # (phi, delta) of each position searched, by hash and side to move
+        self.table = {}
+        # Summary of the last search
+        self.stats = {}
+
+    def prove(self, gobblet, player, deadline=None):
+        # Try to prove that 'player', to move in the position of 'gobblet',
+        # can force a win, giving up at time.perf_counter() 'deadline' if
+        # given. Returns (result, line), where result is "win", "no win" or
+        # "unknown", and line is the list of (move, dest) pairs of the win for
+        # a win, or else empty.
+        start = time.perf_counter()
+        self.deadline = deadline
+        self.nodes = 0
+        self.table = {}
+        self.attacker = player
+        root_key = gobblet.hash ^ gobblet.geo.side_keys[player - 1]
+        self.path_keys = { root_key }
+        try:
+            phi, delta = self.search(gobblet, player, root_key, INFINITY, INFINITY, 0)
+        except NodeBudgetExceeded:
+            phi, delta = 1, 1
+
+        if not phi:
+            result = "win"
+            line = self.winning_line(gobblet, player)
+        else:
+            result = "no win" if not delta else "unknown"
+            line = []
+        seconds = time.perf_counter() - start
+        self.stats = {
+            "result": result,
+            "nodes": self.nodes,
+            "positions": len(self.table),
+            "length": len(line),
+            "seconds": seconds,
+            "nodes_per_second": self.nodes / seconds if seconds else 0,
+        }
+        return result, line
+
+    def choose_move(self, gobblet, player, deadline=None):
+        # Return the first move of a proved win as a [move, dest, score] list,
+        # with a search win score, or None if no win was proved
+        result, line = self.prove(gobblet, player, deadline)
+        if result != "win":
+            return None
+        move, dest = line[0]
+        return [ move, dest, gobblet.win_score - len(line) ]
+
+    def draw_numbers(self, player):
+        # A draw is a loss for the attacker, and so a win for the defender
+        return (INFINITY, 0) if player == self.attacker else (0, INFINITY)
+
+    def children(self, gobblet, player, ply):
+        # The moves of 'player' as [move, dest, key, phi, delta] lists, with
+        # phi and delta for the opponent to move after each, from the table
+        # or the game's result if the move ends it
+        side_keys = gobblet.geo.side_keys
+        history = gobblet.position_counts
+        table = self.table
+        children = []
+        for move, dest, _ in gobblet.get_legal_moves(player, unique=True):
+            undo = gobblet.make_move(player, move, dest)
+            winner = gobblet.is_a_winner(player)
+            key = gobblet.hash ^ side_keys[2 - player]
+            gobblet.undo_move(undo)
+            if winner == player:
+                phi, delta = INFINITY, 0
+            elif winner:
+                phi, delta = 0, INFINITY
+            elif key in self.path_keys or key in history or ply + 1 >= self.max_depth:
+                phi, delta = self.draw_numbers(3 - player)
+            else:
+                phi, delta = table.get(key, (1, 1))
+            children.append([ move, dest, key, phi, delta ])
+            # Nothing more is needed once a move wins on the spot
+            if winner == player:
+                break
+        return children
+
+    def search(self, gobblet, player, key, threshold_phi, threshold_delta, ply):
+        # Search the position with 'player' to move until its phi or delta
+        # reaches its threshold, and return its (phi, delta)
+        self.nodes += 1
+        if self.nodes > self.max_nodes:
+            raise NodeBudgetExceeded()
+        # The clock is only read every 64 nodes
+        if self.deadline is not None and not self.nodes & 63 and time.perf_counter() > self.deadline:
+            raise NodeBudgetExceeded()
+        children = self.children(gobblet, player, ply)
+        if not children:
+            # No legal move: a draw
+            phi, delta = self.draw_numbers(player)
+            self.table[key] = (phi, delta)
+            return phi, delta
+
+        while True:
+            phi = INFINITY
+            delta = 0
+            best = None
+            second_delta = INFINITY
+            for child in children:
+                child_delta = child[4]
+                if child_delta < phi:
+                    second_delta = phi
+                    phi = child_delta
+                    best = child
+                elif child_delta < second_delta:
+                    second_delta = child_delta
+                delta += child[3]
+            delta = min(delta, INFINITY)
+            if phi >= threshold_phi or delta >= threshold_delta:
+                break
+
+            child_threshold_phi = threshold_delta - delta + best[3]
+            child_threshold_delta = min(threshold_phi, second_delta + 1)
+            undo = gobblet.make_move(player, best[0], best[1])
+            self.path_keys.add(best[2])
+            try:
+                best[3], best[4] = self.search(gobblet, 3 - player, best[2], child_threshold_phi,
+                                               child_threshold_delta, ply + 1)
+            finally:
+                self.path_keys.discard(best[2])
+                gobblet.undo_move(undo)
+
+        self.table[key] = (phi, delta)
+        return phi, delta
+
+    def winning_line(self, gobblet, player):
+        # Follow the proof from the root: for the attacker a move that wins on
+        # the spot, or else one into a proved loss for the defender, and for
+        # the defender any move, as all of them lose, but preferably one that
+        # does not lose on the spot. Leaves the board as it was found.
+        line = []
+        undos = []
+        seen = set()
+        while len(line) < self.max_depth:
+            key = gobblet.hash ^ gobblet.geo.side_keys[player - 1]
+            seen.add(key)
+            choice = None
+            for move, dest, child_key, phi, delta in self.children(gobblet, player, 0):
+                if child_key in seen:
+                    continue
+                if player == self.attacker and phi == INFINITY and not delta:
+                    # A proved loss for the defender to move
+                    undo = gobblet.make_move(player, move, dest)
+                    ends = gobblet.is_a_winner(player)
+                    gobblet.undo_move(undo)
+                elif player != self.attacker and not phi:
+                    undo = gobblet.make_move(player, move, dest)
+                    ends = gobblet.is_a_winner(player)
+                    gobblet.undo_move(undo)
+                    # Only a move that loses on the spot ends the game
+                    ends = not ends
+                else:
+                    continue
+                if choice is None or ends:
+                    choice = (move, dest)
+                if ends:
+                    break
+            if choice is None:
+                break
+            line.append(choice)
+            undos.append(gobblet.make_move(player, choice[0], choice[1]))
+            if gobblet.is_a_winner(player):
+                break
+            player = 3 - player
+        for undo in reversed(undos):
+            gobblet.undo_move(undo)
+        return line
+
+def main():
+    parser = argparse.ArgumentParser(description="Prove or disprove a forced Gobblet win")
+    parser.add_argument("position",
+                        help="position to search, as written by Gobblet.position_string")
+    parser.add_argument("--max-nodes", type=int, default=1000000, help="node budget")
+    parser.add_argument("--size", type=int, default=4, help="board size")
+    parser.add_argument("--sizes", type=int, default=4, help="number of piece sizes")
+    parser.add_argument("--stacks", type=int, default=3, help="number of stacks per player")
+    args = parser.parse_args()
+
+    gobblet = Gobblet(tt_mb=0, board_size=args.size, num_sizes=args.sizes, num_stacks=args.stacks)
+    try:
+        board, stacks, player = gobblet.parse_position(args.position)
+    except ValueError as error:
+        parser.error(f"bad position: {error}")
+    gobblet.set_position(board, stacks)
+    pns = ProofNumberSearch(args.max_nodes)
+    result, line = pns.prove(gobblet, player)
+    moves = " ".join(flip_notation(move) + flip_notation(dest) for move, dest in line)
+    print(f"{result} {moves}".strip())
+    print(f"{pns.nodes} nodes in {pns.stats['seconds']:.2f}s")
+
+if __name__ == "__main__":
+    main()
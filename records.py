@@ -0,0 +1,202 @@
+#!/usr/local/bin/python3
+
+"""
+Compact binary game records for Gobblet.
+
+A record file holds any number of games of one variant (board size, number of
+piece sizes and number of stacks per player, as for the Gobblet class). Games
+are written one after another as they finish, and read back one at a time by a
+generator, so archives of millions of games can be scanned in constant memory.
+
+Each move is stored as a single code, source * num_squares + destination,
+where sources use the numbering of Geometry.encode_source (squares, then a new
+piece of each size) and destinations are bitboard square indexes. The codes of
+a game are packed into a little-endian bit string of just enough bits per
+move for the variant: 9 bits on the standard 4x4 board, where the 20 sources
+and 16 destinations make 320 codes, too many for one byte.
+
+File layout (little-endian):
+
+  header: 8-byte magic "GOBGAME1", 1-byte board size, 1-byte number of piece
+          sizes, 1-byte number of stacks, 1 pad byte
+  games:  8-byte seed, 1-byte result (0 undecided, or the winning player),
+          1-byte flags (bit 0 set if the game has a seed), 2-byte number of
+          moves, then the packed moves, padded to a whole byte
+
+Player 1 moves first in every game.
+
+Usage:
+
+  ./selfplay.py --games 100000 --records games.bin
+  ./records.py games.bin --verify
+"""
+
+import argparse
+import json
+import struct
+
+from gobblet import Gobblet, flip_notation, get_geometry
+
+RECORDS_MAGIC = b"GOBGAME1"
+HEADER = struct.Struct("<8sBBBx")
+GAME = struct.Struct("<QBBH")
+
+# Flags of a game
+HAS_SEED = 1
+
+def move_bits(geo):
+    # Bits needed for the largest move code of a variant
+    num_codes = (geo.num_squares + geo.num_sizes) * geo.num_squares
+    return (num_codes - 1).bit_length()
+
+class RecordWriter:
+    # Writes games to a new record file
+
+    def __init__(self, path, board_size=4, num_sizes=4, num_stacks=3):
+        self.geo = get_geometry(board_size, num_sizes, num_stacks)
+        self.bits = move_bits(self.geo)
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(RECORDS_MAGIC, board_size, num_sizes, num_stacks))
+        self.count = 0
+
+    def write_game(self, moves, winner=0, seed=None):
+        # Append a game, given as its (move, dest) pairs in internal notation
+        if len(moves) > 0xFFFF:
+            raise ValueError("too many moves for a game record")
+        if seed is not None and not 0 <= seed < 1 << 64:
+            raise ValueError("seed must fit in 64 bits")
+        geo = self.geo
+        packed = 0
+        shift = 0
+        for move, dest in moves:
+            code = geo.encode_source(move) * geo.num_squares + geo.square_index[dest]
+            packed |= code << shift
+            shift += self.bits
+        flags = HAS_SEED if seed is not None else 0
+        self.file.write(GAME.pack(seed or 0, winner, flags, len(moves)))
+        self.file.write(packed.to_bytes((shift + 7) // 8, "little"))
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+class RecordReader:
+    # Reads the games of a record file in order
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        header = self.file.read(HEADER.size)
+        if len(header) != HEADER.size or header[:8] != RECORDS_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a Gobblet game record file")
+        _, self.board_size, self.num_sizes, self.num_stacks = HEADER.unpack(header)
+        self.geo = get_geometry(self.board_size, self.num_sizes, self.num_stacks)
+        self.bits = move_bits(self.geo)
+
+    def games(self):
+        # Generator yielding each game as a dict of the form
+        #   { "seed": 1012, "winner": 2, "moves": [ ("4", "BB"), ... ] }
+        # with moves in internal notation and seed None if none was stored
+        geo = self.geo
+        bits = self.bits
+        code_mask = (1 << bits) - 1
+        num_squares = geo.num_squares
+        square_names = geo.square_names
+        # Sources of every code, decoded once
+        sources = [ geo.decode_source(source) for source in range(num_squares + geo.num_sizes) ]
+        read = self.file.read
+        while True:
+            header = read(GAME.size)
+            if not header:
+                return
+            if len(header) != GAME.size:
+                raise ValueError("game record file is truncated")
+            seed, winner, flags, num_moves = GAME.unpack(header)
+            size = (num_moves * bits + 7) // 8
+            data = read(size)
+            if len(data) != size:
+                raise ValueError("game record file is truncated")
+            packed = int.from_bytes(data, "little")
+            moves = []
+            for _ in range(num_moves):
+                source, dest = divmod(packed & code_mask, num_squares)
+                moves.append((sources[source], square_names[dest]))
+                packed >>= bits
+            yield {
+                "seed": seed if flags & HAS_SEED else None,
+                "winner": winner,
+                "moves": moves,
+            }
+
+    def close(self):
+        self.file.close()
+
+def read_games(path):
+    # Generator over the games of a record file, closing it when done
+    reader = RecordReader(path)
+    try:
+        yield from reader.games()
+    finally:
+        reader.close()
+
+def replay_game(gobblet, game):
+    # Generator replaying a game from the start through Gobblet.do_move,
+    # yielding (player, move, dest) after each move with 'gobblet' set to
+    # the position after it. Raises ValueError on an illegal move.
+    gobblet.set_position([ [ [ 0 ] * gobblet.num_sizes for _ in range(gobblet.board_size) ]
+                           for _ in range(gobblet.board_size) ],
+                         [ [ gobblet.num_sizes ] * gobblet.num_stacks ] * 2)
+    player = 1
+    for move, dest in game["moves"]:
+        if not gobblet.is_legal_move(player, move, dest):
+            raise ValueError(f"illegal move {move}-{dest} for player {player}")
+        gobblet.do_move(gobblet.board, gobblet.player_stacks, player, move, dest)
+        gobblet.sync_bitboards()
+        yield player, move, dest
+        player = 3 - player
+
+def summarize(path, verify=False):
+    # Count the games, moves and results of a record file. With verify, each
+    # game is replayed and its stored result checked against the board.
+    reader = RecordReader(path)
+    gobblet = Gobblet(tt_mb=0, board_size=reader.board_size, num_sizes=reader.num_sizes,
+                      num_stacks=reader.num_stacks)
+    summary = { "games": 0, "moves": 0, "wins": [ 0, 0 ], "undecided": 0, "mismatches": 0 }
+    try:
+        for game in reader.games():
+            summary["games"] += 1
+            summary["moves"] += len(game["moves"])
+            if game["winner"]:
+                summary["wins"][game["winner"] - 1] += 1
+            else:
+                summary["undecided"] += 1
+            if verify:
+                winner = 0
+                for player, _, _ in replay_game(gobblet, game):
+                    winner = gobblet.is_a_winner(player) or 0
+                if winner != game["winner"]:
+                    summary["mismatches"] += 1
+    finally:
+        reader.close()
+    summary["mean_moves"] = summary["moves"] / summary["games"] if summary["games"] else 0
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a file of Gobblet game records")
+    parser.add_argument("path", help="game record file")
+    parser.add_argument("--verify", action="store_true",
+                        help="replay every game and check its result")
+    parser.add_argument("--dump", action="store_true",
+                        help="print every game as a JSON line instead")
+    args = parser.parse_args()
+
+    if args.dump:
+        for game in read_games(args.path):
+            game["moves"] = [ [ flip_notation(move), flip_notation(dest) ]
+                              for move, dest in game["moves"] ]
+            print(json.dumps(game))
+        return
+    print(json.dumps(summarize(args.path, args.verify), indent=2))
+
+if __name__ == "__main__":
+    main()
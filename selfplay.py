@@ -0,0 +1,122 @@
+#!/usr/local/bin/python3
+
+"""
+Headless computer-vs-computer Gobblet games, for generating games in bulk.
+
+Games are spread over a pool of worker processes. Each game seeds the random
+number generator from the base seed plus its game number, so any game can be
+replayed on its own with the same seed, whichever worker played it. Results
+are streamed back as each game finishes, as dicts of the form:
+
+  { "game": 12, "seed": 1012, "winner": 2, "reason": "win", "num_moves": 17,
+    "moves": [ ["4", "BB"], ["4", "CB"], ["BB", "AA"], ... ] }
+
+where winner is 0 for an undecided game, reason is how the game ended
+("win", "repetition", "stuck", "move cap" or "no moves"), and moves use the
+same XY notation as the prompts of ./gobblet.py (column letter first, then row
+letter). With --records, the games are written to a binary game record file
+instead (see records.py).
+
+Usage:
+
+  ./selfplay.py --games 100000 --workers 8 --seed 1 > games.jsonl
+  ./selfplay.py --games 100000 --workers 8 --seed 1 --records games.bin
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+
+from book import open_book
+from gobblet import Gobblet, flip_notation, load_weights
+from mcts import MCTS
+from pns import ProofNumberSearch
+from records import RecordWriter
+
+def play_game(game, seed, think_ms=None, max_moves=200, book_path=None, mcts_iterations=None,
+              pns_nodes=None, weights_path=None):
+    book = open_book(book_path) if book_path else None
+    mcts = MCTS(iterations=mcts_iterations, playout="heuristic") if mcts_iterations else None
+    pns = ProofNumberSearch(pns_nodes) if pns_nodes else None
+    weights = load_weights(weights_path) if weights_path else None
+    gobblet = Gobblet(think_ms=think_ms, book=book, seed=seed, mcts=mcts, pns=pns, weights=weights)
+    winner, moves = gobblet.play_headless(max_moves)
+    return {
+        "game": game,
+        "seed": seed,
+        "winner": winner,
+        "reason": gobblet.end_reason,
+        "num_moves": len(moves),
+        "moves": [ [ flip_notation(move), flip_notation(dest) ] for move, dest in moves ],
+    }
+
+def play_game_task(task):
+    return play_game(*task)
+
+def run_games(num_games, workers=None, seed=0, think_ms=None, max_moves=200, book_path=None,
+              mcts_iterations=None, pns_nodes=None, weights_path=None):
+    # Generator yielding the result of each game as it finishes, in
+    # completion order. workers=1 plays the games in this process.
+    tasks = ((game, seed + game, think_ms, max_moves, book_path, mcts_iterations, pns_nodes,
+              weights_path) for game in range(num_games))
+    if workers == 1:
+        for task in tasks:
+            yield play_game_task(task)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(play_game_task, tasks, chunksize=8):
+            yield result
+
+def main():
+    parser = argparse.ArgumentParser(description="Play headless computer-vs-computer games")
+    parser.add_argument("--games", type=int, default=100, help="number of games to play")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--seed", type=int, default=0, help="base random seed")
+    parser.add_argument("--think-ms", type=int, default=None,
+                        help="search time per move (default: one-move lookahead)")
+    parser.add_argument("--max-moves", type=int, default=200,
+                        help="moves after which a game is stopped undecided")
+    parser.add_argument("--book", default=None, help="opening book file built by book.py")
+    parser.add_argument("--mcts-iterations", type=int, default=None,
+                        help="play with Monte Carlo tree search of this many playouts per move")
+    parser.add_argument("--pns-nodes", type=int, default=None,
+                        help="look for forced wins in sharp positions with proof-number "
+                             "search of this many nodes")
+    parser.add_argument("--weights", default=None,
+                        help="evaluation weights file written by tune.py")
+    parser.add_argument("--output", default=None,
+                        help="file to write JSON lines to (default: stdout)")
+    parser.add_argument("--records", default=None,
+                        help="binary game record file to write instead of JSON lines")
+    args = parser.parse_args()
+    if args.weights:
+        try:
+            load_weights(args.weights)
+        except ValueError as error:
+            parser.error(str(error))
+
+    results = run_games(args.games, args.workers, args.seed, args.think_ms, args.max_moves,
+                        args.book, args.mcts_iterations, args.pns_nodes, args.weights)
+    if args.records:
+        writer = RecordWriter(args.records)
+        try:
+            for result in results:
+                moves = [ (flip_notation(move), flip_notation(dest)) for move, dest in result["moves"] ]
+                writer.write_game(moves, result["winner"], result["seed"])
+        finally:
+            writer.close()
+        return
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
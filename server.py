@@ -0,0 +1,456 @@
+#!/usr/local/bin/python3
+
+"""
+Asyncio game server hosting many concurrent Gobblet games.
+
+Clients connect over TCP (or a Unix socket with --unix) and send one JSON
+object per line, each answered by one JSON line. Games belong to the server,
+not to a connection, so two clients can play one game against each other by
+its id. Moves use the same XY notation as the prompts of ./gobblet.py (column
+letter first, then row letter), and are checked with check_from and check_to.
+
+Requests:
+
+  {"op": "new", "players": ["human", "computer"], "think_ms": 200, "seed": 1}
+      Start a game. Each player is "human" or "computer". Optional settings:
+      think_ms (alpha-beta search time per move, default one move of
+      lookahead), mcts_iterations (use Monte Carlo tree search instead), seed,
+      board_size (3 to 8), num_stacks (1 to 8) and num_sizes (1 to 4).
+      think_ms and mcts_iterations must be positive integers no larger than
+      MAX_THINK_MS and MAX_MCTS_ITERATIONS. Any computer moves due are played before the reply.
+  {"op": "move", "game": 1, "move": "4", "dest": "BA"}
+      Play a human move: a piece size or the square of a piece to move, and
+      the destination square. The computer's reply, if due, is played too.
+  {"op": "state", "game": 1}
+  {"op": "close", "game": 1}
+  {"op": "stats"}
+      Server-wide counters: games, requests and moves per second, and the
+      mean and maximum request and engine latency.
+
+Replies to requests about a game carry its state:
+
+  {"ok": true, "game": 1, "to_move": 1, "winner": 0, "over": false,
+   "reason": null, "moves": [{"player": 2, "move": "4", "dest": "CB"}],
+   "board": [[[0, 0, 0, 0], ...], ...], "stacks": [[4, 4, 4], [3, 4, 4]],
+   "stats": {"moves": 2, "engine_moves": 1, "engine_seconds": 0.2,
+             "last_latency": 0.21}}
+
+where "reason" is how a game that is over ended ("win", "repetition",
+"stuck" or "no moves"), "moves" are the moves played by that request, and
+board and stacks are
+in the format of Gobblet.board and Gobblet.player_stacks. Errors are answered
+with {"ok": false, "error": "..."}. A move whose computer reply fails is
+taken back, leaving the game as it was before the request.
+
+Computer moves are searched in a bounded pool of worker processes, so a slow
+search never holds up the event loop or the other games.
+
+With --records, each game of the standard 4x4 variant is written to a binary
+game record file (see records.py) when it is won, drawn or closed.
+
+Usage:
+
+  ./server.py --port 7777 --engine-workers 4 --records games.bin
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+
+from gobblet import Gobblet, flip_notation
+from mcts import MCTS
+from records import RecordWriter
+
+# Each engine worker process keeps one Gobblet per variant and engine
+# settings, so that its transposition table stays warm, dropping the least
+# recently used beyond ENGINE_CACHE_SIZE
+ENGINE_CACHE_SIZE = 8
+engine_games = collections.OrderedDict()
+
+# Largest engine settings a client may ask for
+MAX_THINK_MS = 60000
+MAX_MCTS_ITERATIONS = 1000000
+
+# Variants a client may ask for, as (smallest, largest) of each setting, the
+# same as engine.py allows
+BOARD_SIZES = (3, 8)
+NUM_SIZES = (1, 4)
+NUM_STACKS = (1, 8)
+
+def engine_move(task):
+    # Choose the computer's move in an engine worker process. Returns the
+    # move as a [move, dest, score] list in internal notation, or None.
+    board, stacks, player, variant, think_ms, mcts_iterations, seed, history, quiet_moves = task
+    key = (variant, think_ms, mcts_iterations)
+    if key in engine_games:
+        engine_games.move_to_end(key)
+    else:
+        board_size, num_stacks, num_sizes = variant
+        mcts = MCTS(iterations=mcts_iterations, playout="heuristic") if mcts_iterations else None
+        engine_games[key] = Gobblet(think_ms=think_ms, board_size=board_size,
+                                    num_stacks=num_stacks, num_sizes=num_sizes, mcts=mcts)
+        if len(engine_games) > ENGINE_CACHE_SIZE:
+            engine_games.popitem(last=False)
+    gobblet = engine_games[key]
+    gobblet.set_position(board, stacks)
+    gobblet.position_counts = dict.fromkeys(history, 1)
+    gobblet.quiet_moves = quiet_moves
+    gobblet.random.seed(seed)
+    return gobblet.choose_move(player)
+
+class Game:
+    # One game hosted by the server
+
+    def __init__(self, game_id, players, think_ms, mcts_iterations, seed, board_size,
+                 num_stacks, num_sizes):
+        self.game_id = game_id
+        self.computer_players = [ player == "computer" for player in players ]
+        self.think_ms = think_ms
+        self.mcts_iterations = mcts_iterations
+        self.variant = (board_size, num_stacks, num_sizes)
+        # The game's own Gobblet only checks and makes moves, so it needs no
+        # transposition table to speak of
+        self.gobblet = Gobblet(tt_mb=0, seed=seed, board_size=board_size,
+                               num_stacks=num_stacks, num_sizes=num_sizes)
+        self.gobblet.quiet = True
+        self.gobblet.reset_history(1)
+        self.seed = seed
+        # Moves played, in internal notation, for the game record
+        self.moves = []
+        self.recorded = False
+        self.to_move = 1
+        self.winner = 0
+        self.over = False
+        self.reason = None
+        # Requests for one game are handled one at a time
+        self.lock = asyncio.Lock()
+        self.engine_moves = 0
+        self.engine_seconds = 0.0
+        self.last_latency = 0.0
+
+    def snapshot(self):
+        # Everything play changes, for restore to take moves back with
+        gobblet = self.gobblet
+        board = [ [ list(square) for square in row ] for row in gobblet.board ]
+        stacks = [ list(player_stacks) for player_stacks in gobblet.player_stacks ]
+        return (board, stacks, dict(gobblet.position_counts),
+                gobblet.quiet_moves, gobblet.num_moves, len(self.moves), self.to_move,
+                self.winner, self.over, self.reason)
+
+    def restore(self, snapshot):
+        (board, stacks, position_counts, quiet_moves, num_moves, num_played, self.to_move,
+         self.winner, self.over, self.reason) = snapshot
+        gobblet = self.gobblet
+        gobblet.set_position(board, stacks)
+        gobblet.position_counts = position_counts
+        gobblet.quiet_moves = quiet_moves
+        gobblet.num_moves = num_moves
+        del self.moves[num_played:]
+
+    def play(self, move, dest):
+        # Make a move in internal notation for the player to move
+        player = self.to_move
+        self.gobblet.num_moves += 1
+        self.gobblet.make_move(player, move, dest)
+        self.moves.append((move, dest))
+        self.winner = self.gobblet.is_a_winner(player) or 0
+        if self.winner:
+            self.over = True
+            self.reason = "win"
+        else:
+            # Games going round in circles are drawn
+            self.reason = self.gobblet.record_move(player, move)
+            self.over = bool(self.reason)
+        self.to_move = 3 - player
+        return { "player": player, "move": flip_notation(move), "dest": flip_notation(dest) }
+
+    def state(self, moves):
+        return {
+            "ok": True,
+            "game": self.game_id,
+            "to_move": self.to_move,
+            "winner": self.winner,
+            "over": self.over,
+            "reason": self.reason,
+            "moves": moves,
+            "board": self.gobblet.board,
+            "stacks": self.gobblet.player_stacks,
+            "stats": {
+                "moves": self.gobblet.num_moves,
+                "engine_moves": self.engine_moves,
+                "engine_seconds": self.engine_seconds,
+                "last_latency": self.last_latency,
+            },
+        }
+
+class RequestError(Exception):
+    # A request that cannot be carried out, answered with its message
+    pass
+
+def bounded_int(request, name, limit, low=1, default=None):
+    # An optional setting of a request, which must be an integer from 'low'
+    # to 'limit' if given, and is 'default' if not
+    value = request.get(name)
+    if value is None:
+        return default
+    if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= limit:
+        raise RequestError(f"{name} must be an integer from {low} to {limit}")
+    return value
+
+class GameServer:
+
+    def __init__(self, engine_workers=None, max_games=100000, records_path=None):
+        self.executor = concurrent.futures.ProcessPoolExecutor(engine_workers)
+        self.records = RecordWriter(records_path) if records_path else None
+        self.max_games = max_games
+        self.games = {}
+        self.next_game_id = 1
+        self.start_time = time.perf_counter()
+        self.counters = {
+            "games_started": 0,
+            "games_finished": 0,
+            "requests": 0,
+            "errors": 0,
+            "moves": 0,
+            "engine_moves": 0,
+            "engine_seconds": 0.0,
+            "engine_max_seconds": 0.0,
+            "request_seconds": 0.0,
+            "request_max_seconds": 0.0,
+        }
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # A line longer than the stream limit, which the reader
+                    # has dropped; the rest of it is answered as a bad request
+                    self.counters["requests"] += 1
+                    self.counters["errors"] += 1
+                    reply = { "ok": False, "error": "request line too long" }
+                    writer.write(json.dumps(reply).encode() + b"\n")
+                    await writer.drain()
+                    continue
+                if not line:
+                    break
+                reply = await self.handle_line(line)
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_line(self, line):
+        start = time.perf_counter()
+        self.counters["requests"] += 1
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise RequestError("request must be a JSON object")
+            reply = await self.handle_request(request)
+        except (ValueError, RequestError) as error:
+            self.counters["errors"] += 1
+            reply = { "ok": False, "error": str(error) }
+        seconds = time.perf_counter() - start
+        self.counters["request_seconds"] += seconds
+        self.counters["request_max_seconds"] = max(self.counters["request_max_seconds"], seconds)
+        return reply
+
+    async def handle_request(self, request):
+        op = request.get("op")
+        if op == "new":
+            return await self.new_game(request)
+        elif op == "stats":
+            return self.server_stats()
+
+        game_id = request.get("game")
+        if not isinstance(game_id, int) or isinstance(game_id, bool):
+            raise RequestError("game must be an integer")
+        game = self.games.get(game_id)
+        if game is None:
+            raise RequestError("no such game")
+        start = time.perf_counter()
+        async with game.lock:
+            if op == "move":
+                reply = await self.human_move(game, request)
+            elif op == "state":
+                reply = game.state([])
+            elif op == "close":
+                del self.games[game.game_id]
+                self.record_game(game)
+                reply = { "ok": True, "game": game.game_id }
+            else:
+                raise RequestError(f"unknown op {op!r}")
+        game.last_latency = time.perf_counter() - start
+        return reply
+
+    async def new_game(self, request):
+        if len(self.games) >= self.max_games:
+            raise RequestError("too many games")
+        players = request.get("players", [ "human", "computer" ])
+        if (not isinstance(players, list) or len(players) != 2
+                or any(player not in ("human", "computer") for player in players)):
+            raise RequestError("players must be a list of 2 of 'human' or 'computer'")
+        think_ms = bounded_int(request, "think_ms", MAX_THINK_MS)
+        mcts_iterations = bounded_int(request, "mcts_iterations", MAX_MCTS_ITERATIONS)
+        seed = request.get("seed")
+        if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+            raise RequestError("seed must be an integer")
+        board_size = bounded_int(request, "board_size", BOARD_SIZES[1], BOARD_SIZES[0], 4)
+        num_stacks = bounded_int(request, "num_stacks", NUM_STACKS[1], NUM_STACKS[0], 3)
+        num_sizes = bounded_int(request, "num_sizes", NUM_SIZES[1], NUM_SIZES[0], 4)
+        game = Game(self.next_game_id, players, think_ms, mcts_iterations, seed, board_size,
+                    num_stacks, num_sizes)
+        self.games[game.game_id] = game
+        self.next_game_id += 1
+        self.counters["games_started"] += 1
+        start = time.perf_counter()
+        async with game.lock:
+            try:
+                moves = await self.computer_moves(game)
+            except RequestError:
+                # A game whose first computer move failed is of no use
+                del self.games[game.game_id]
+                raise
+        game.last_latency = time.perf_counter() - start
+        return game.state(moves)
+
+    async def human_move(self, game, request):
+        if game.over:
+            raise RequestError("game is over")
+        if game.computer_players[game.to_move - 1]:
+            raise RequestError("it is the computer's move")
+        move = request.get("move")
+        dest = request.get("dest")
+        if not isinstance(move, str) or not isinstance(dest, str):
+            raise RequestError("move and dest must be strings")
+        move = flip_notation(move.upper())
+        dest = flip_notation(dest.upper())
+        gobblet = game.gobblet
+        gobblet.move_error = None
+        try:
+            size = gobblet.check_from(game.to_move, move)
+        except ValueError:
+            raise RequestError("Invalid move: expected a piece size or grid co-ordinate")
+        if not size or not gobblet.check_to(game.to_move, size, dest):
+            raise RequestError(gobblet.move_error or "Invalid move")
+        # If the computer's reply fails, the human's move is taken back too,
+        # so that the game is left as it was before the request
+        snapshot = game.snapshot()
+        moves = [ game.play(move, dest) ]
+        try:
+            moves.extend(await self.computer_moves(game))
+        except RequestError:
+            game.restore(snapshot)
+            raise
+        self.counters["moves"] += len(moves)
+        return game.state(moves)
+
+    async def computer_moves(self, game):
+        # Play computer moves until it is a human's turn or the game is over.
+        # Raises RequestError if the engine fails, leaving any moves it did
+        # play on the board for the caller to take back.
+        moves = []
+        loop = asyncio.get_running_loop()
+        while not game.over and game.computer_players[game.to_move - 1]:
+            gobblet = game.gobblet
+            task = (gobblet.board, gobblet.player_stacks, game.to_move, game.variant,
+                    game.think_ms, game.mcts_iterations, gobblet.random.getrandbits(64),
+                    list(gobblet.position_counts), gobblet.quiet_moves)
+            start = time.perf_counter()
+            try:
+                move = await loop.run_in_executor(self.executor, engine_move, task)
+            except Exception as error:
+                raise RequestError(f"engine failed: {error}")
+            seconds = time.perf_counter() - start
+            game.engine_moves += 1
+            game.engine_seconds += seconds
+            self.counters["engine_moves"] += 1
+            self.counters["engine_seconds"] += seconds
+            self.counters["engine_max_seconds"] = max(self.counters["engine_max_seconds"], seconds)
+            if move is None:
+                # The computer cannot move, so the game ends undecided
+                game.over = True
+                game.reason = "no moves"
+                break
+            moves.append(game.play(move[0], move[1]))
+        if game.over:
+            self.counters["games_finished"] += 1
+            self.record_game(game)
+        return moves
+
+    def record_game(self, game):
+        # Write a game to the record file, once, if it is of the file's variant
+        if self.records is None or game.recorded or not game.moves:
+            return
+        geo = self.records.geo
+        if game.variant != (geo.size, geo.num_stacks, geo.num_sizes):
+            return
+        seed = game.seed if isinstance(game.seed, int) and 0 <= game.seed < 1 << 64 else None
+        self.records.write_game(game.moves, game.winner, seed)
+        game.recorded = True
+
+    def server_stats(self):
+        counters = self.counters
+        uptime = time.perf_counter() - self.start_time
+        return {
+            "ok": True,
+            "uptime": uptime,
+            "active_games": len(self.games),
+            **counters,
+            "requests_per_second": counters["requests"] / uptime,
+            "moves_per_second": counters["moves"] / uptime,
+            "request_mean_seconds": counters["request_seconds"] / max(1, counters["requests"]),
+            "engine_mean_seconds": counters["engine_seconds"] / max(1, counters["engine_moves"]),
+        }
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        if self.records is not None:
+            # Games still being played are recorded as undecided
+            for game in self.games.values():
+                self.record_game(game)
+            self.records.close()
+
+async def serve(host, port, unix_path=None, engine_workers=None, max_games=100000,
+                records_path=None):
+    game_server = GameServer(engine_workers, max_games, records_path)
+    # A long listen queue, so that bursts of new clients are not turned away
+    if unix_path:
+        server = await asyncio.start_unix_server(game_server.handle_connection, unix_path,
+                                                 backlog=1024)
+    else:
+        server = await asyncio.start_server(game_server.handle_connection, host, port,
+                                            backlog=1024)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        game_server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Gobblet games over line-delimited JSON")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=7777, help="TCP port to listen on")
+    parser.add_argument("--unix", default=None, help="listen on this Unix socket instead")
+    parser.add_argument("--engine-workers", type=int, default=None,
+                        help="processes searching computer moves (default: one per CPU)")
+    parser.add_argument("--max-games", type=int, default=100000,
+                        help="most games hosted at once")
+    parser.add_argument("--records", default=None,
+                        help="binary game record file to write finished games to")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.engine_workers, args.max_games,
+                          args.records))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
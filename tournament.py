@@ -0,0 +1,312 @@
+#!/usr/local/bin/python3
+
+"""
+Matches between two engine configurations, for telling whether a change to
+the search or the evaluation makes the computer player stronger.
+
+Each engine is given as a comma-separated list of settings:
+
+  think_ms=N    search time per move (default: one-move lookahead)
+  depth=N       search depth limit
+  tt_mb=N       transposition table size in MB
+  weights=PATH  evaluation weights file written by tune.py
+  book=PATH     opening book file built by book.py
+  mcts=N        Monte Carlo tree search of this many playouts per move
+  pns=N         proof-number search of this many nodes in sharp positions
+
+An empty list is the default engine. Games are played in pairs with the same
+seed, the engines swapping colors, so that neither gains from moving first.
+The pairs are spread over a pool of worker processes, and results are taken
+in completion order.
+
+After each pair, a sequential probability ratio test weighs the hypothesis
+that engine 1 is elo0 Elo stronger than engine 2 against the hypothesis that
+it is elo1 stronger, with the normal approximation to the distribution of
+game scores (wins count 1, draws and undecided games 0.5). The match stops
+as soon as the log-likelihood ratio crosses either bound set by alpha and
+beta, the chances of accepting elo1 when elo0 is true and the other way
+round, or after --games games. The summary is written as JSON:
+
+  { "games": 412, "wins": 171, "draws": 82, "losses": 159, "score": 0.5146,
+    "elo": 10.1, "elo_error": 27.8, "llr": -2.95, "bounds": [-2.94, 2.94],
+    "result": "H0", ... }
+
+where elo_error is the half-width of the 95% confidence interval of elo, and
+result is "H1" if engine 1 was shown to be stronger, "H0" if not and None if
+the match ran out of games first.
+
+Usage:
+
+  ./tournament.py --engine1 think_ms=50,weights=weights.json --engine2 think_ms=50
+  ./tournament.py --engine1 depth=3 --engine2 depth=2 --elo0 0 --elo1 20 --games 2000
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import sys
+import time
+
+from book import open_book
+from gobblet import Gobblet, load_weights
+from mcts import MCTS
+from pns import ProofNumberSearch
+
+# Settings of an engine, and how to read each from its string
+ENGINE_SETTINGS = {
+    "think_ms": int,
+    "depth": int,
+    "tt_mb": int,
+    "weights": str,
+    "book": str,
+    "mcts": int,
+    "pns": int,
+}
+
+def parse_engine(spec):
+    # Read an engine's settings from a string like "think_ms=50,depth=6"
+    # into a dict. Raises ValueError for an unknown or malformed setting.
+    settings = {}
+    for item in spec.split(","):
+        if not item:
+            continue
+        name, sep, value = item.partition("=")
+        if not sep or name not in ENGINE_SETTINGS:
+            raise ValueError(f"bad engine setting: {item}")
+        settings[name] = ENGINE_SETTINGS[name](value)
+    return settings
+
+def make_engine(settings, seed):
+    # Set up a Gobblet playing with an engine's settings
+    book = open_book(settings["book"]) if "book" in settings else None
+    mcts = MCTS(iterations=settings["mcts"], playout="heuristic") if "mcts" in settings else None
+    pns = ProofNumberSearch(settings["pns"]) if "pns" in settings else None
+    weights = load_weights(settings["weights"]) if "weights" in settings else None
+    gobblet = Gobblet(think_ms=settings.get("think_ms"), tt_mb=settings.get("tt_mb", 16),
+                      book=book, seed=seed, mcts=mcts, pns=pns, weights=weights)
+    if "depth" in settings:
+        # A depth limit alone searches to that depth, however long it takes
+        gobblet.think_ms = gobblet.think_ms or float("inf")
+        gobblet.max_depth = settings["depth"]
+    return gobblet
+
+def play_match_game(first, second, seed, max_moves=200):
+    # Play one game between two engines, 'first' moving first, each keeping
+    # its own copy of the board. Returns the winner (1 for 'first', 2 for
+    # 'second', 0 for a draw or an undecided game) and the reason the game
+    # ended, as in Gobblet.play_headless.
+    engines = [ make_engine(first, seed), make_engine(second, seed) ]
+    for engine in engines:
+        engine.reset_history(1)
+    player = 1
+    for _ in range(max_moves):
+        move = engines[player - 1].choose_move(player)
+        if not move:
+            return 0, "no moves"
+        reason = None
+        for engine in engines:
+            engine.num_moves += 1
+            engine.make_move(player, move[0], move[1])
+            reason = engine.record_move(player, move[0])
+        winner = engines[0].is_a_winner(player)
+        if winner:
+            return winner, "win"
+        if reason:
+            return 0, reason
+        player = 3 - player
+    return 0, "move cap"
+
+def play_pair(task):
+    # Play a pair of games with the same seed, engine 1 moving first in the
+    # first, and return engine 1's results and the reasons the games ended
+    pair, engine1, engine2, seed, max_moves = task
+    winner, reason = play_match_game(engine1, engine2, seed, max_moves)
+    swapped_winner, swapped_reason = play_match_game(engine2, engine1, seed, max_moves)
+    results = [ { 1: "win", 2: "loss" }.get(winner, "draw"),
+                { 1: "loss", 2: "win" }.get(swapped_winner, "draw") ]
+    return pair, results, [ reason, swapped_reason ]
+
+def run_pairs(num_pairs, engine1, engine2, workers=None, seed=0, max_moves=200):
+    # Generator yielding the result of each pair of games as it finishes, in
+    # completion order. workers=1 plays the games in this process. Closing
+    # the generator stops the workers.
+    tasks = ((pair, engine1, engine2, seed + pair, max_moves) for pair in range(num_pairs))
+    if workers == 1:
+        for task in tasks:
+            yield play_pair(task)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(play_pair, tasks):
+            yield result
+
+def elo_from_score(score):
+    # Elo difference for an expected score, or None if it is 0 or 1
+    if score <= 0 or score >= 1:
+        return None
+    return 400 * math.log10(score / (1 - score))
+
+def score_from_elo(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+class MatchStats:
+    # Win, draw and loss counts of engine 1, and what they say about the
+    # difference in strength
+
+    def __init__(self, elo0=0, elo1=10, alpha=0.05, beta=0.05):
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+
+    def add(self, result):
+        if result == "win":
+            self.wins += 1
+        elif result == "loss":
+            self.losses += 1
+        else:
+            self.draws += 1
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    def score(self):
+        return (self.wins + 0.5 * self.draws) / self.games
+
+    def variance(self):
+        # Variance of the score of one game
+        score = self.score()
+        return (self.wins * (1 - score) ** 2 + self.draws * (0.5 - score) ** 2
+                + self.losses * score ** 2) / self.games
+
+    def llr(self):
+        # Log-likelihood ratio of elo1 against elo0, taking the scores to be
+        # normally distributed with the observed variance. Half a game of
+        # each result is added to the variance, which would otherwise be 0
+        # for a match of all wins, and keep the test from ever stopping.
+        if not self.games:
+            return 0.0
+        score = self.score()
+        variance = (self.variance() * self.games + 0.5 * ((1 - score) ** 2 + (0.5 - score) ** 2
+                                                          + score ** 2)) / (self.games + 1.5)
+        s0 = score_from_elo(self.elo0)
+        s1 = score_from_elo(self.elo1)
+        return self.games * (s1 - s0) * (2 * score - s0 - s1) / (2 * variance)
+
+    def decision(self):
+        # "H1" once elo1 is accepted, "H0" once elo0 is, else None
+        llr = self.llr()
+        if llr >= self.upper:
+            return "H1"
+        if llr <= self.lower:
+            return "H0"
+        return None
+
+    def elo(self):
+        # Elo estimate and the half-width of its 95% confidence interval,
+        # either of which is None when the score is all wins or all losses
+        score = self.score()
+        elo = elo_from_score(score)
+        margin = 1.96 * math.sqrt(self.variance() / self.games)
+        low = elo_from_score(score - margin)
+        high = elo_from_score(score + margin)
+        error = (high - low) / 2 if low is not None and high is not None else None
+        return elo, error
+
+    def summary(self):
+        elo, error = self.elo()
+        return {
+            "games": self.games,
+            "wins": self.wins,
+            "draws": self.draws,
+            "losses": self.losses,
+            "score": round(self.score(), 4),
+            "elo": round(elo, 1) if elo is not None else None,
+            "elo_error": round(error, 1) if error is not None else None,
+            "llr": round(self.llr(), 3),
+            "bounds": [ round(self.lower, 3), round(self.upper, 3) ],
+            "elo0": self.elo0,
+            "elo1": self.elo1,
+            "result": self.decision(),
+        }
+
+def run_match(engine1, engine2, max_games=10000, workers=None, seed=0, max_moves=200,
+              elo0=0, elo1=10, alpha=0.05, beta=0.05, progress=None):
+    # Play pairs of games until the SPRT is decided or max_games games have
+    # been played, and return the summary. 'progress', if given, is called
+    # with the stats after each pair.
+    stats = MatchStats(elo0, elo1, alpha, beta)
+    reasons = {}
+    results = run_pairs((max_games + 1) // 2, engine1, engine2, workers, seed, max_moves)
+    try:
+        for _, pair_results, pair_reasons in results:
+            for result in pair_results:
+                stats.add(result)
+            for reason in pair_reasons:
+                reasons[reason] = reasons.get(reason, 0) + 1
+            if progress:
+                progress(stats)
+            if stats.decision():
+                break
+    finally:
+        results.close()
+    return { **stats.summary(), "end_reasons": reasons }
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a match between two engine configurations")
+    parser.add_argument("--engine1", default="", help="settings of the engine under test")
+    parser.add_argument("--engine2", default="", help="settings of the reference engine")
+    parser.add_argument("--games", type=int, default=10000,
+                        help="games after which the match stops undecided")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--seed", type=int, default=0, help="base random seed")
+    parser.add_argument("--max-moves", type=int, default=200,
+                        help="moves after which a game is stopped undecided")
+    parser.add_argument("--elo0", type=float, default=0, help="Elo difference of H0")
+    parser.add_argument("--elo1", type=float, default=10, help="Elo difference of H1")
+    parser.add_argument("--alpha", type=float, default=0.05,
+                        help="chance of accepting H1 when H0 is true")
+    parser.add_argument("--beta", type=float, default=0.05,
+                        help="chance of accepting H0 when H1 is true")
+    parser.add_argument("--output", default=None,
+                        help="file to write the JSON summary to (default: stdout)")
+    args = parser.parse_args()
+
+    try:
+        engine1 = parse_engine(args.engine1)
+        engine2 = parse_engine(args.engine2)
+        for settings in (engine1, engine2):
+            if "weights" in settings:
+                load_weights(settings["weights"])
+    except ValueError as error:
+        parser.error(str(error))
+
+    def progress(stats):
+        elo, error = stats.elo()
+        elo_text = f"{elo:+.1f}" if elo is not None else "n/a"
+        error_text = f" +/- {error:.1f}" if error is not None else ""
+        print(f"\r{stats.games} games  +{stats.wins} ={stats.draws} -{stats.losses}  "
+              f"elo {elo_text}{error_text}  llr {stats.llr():.2f} "
+              f"[{stats.lower:.2f}, {stats.upper:.2f}]", end="", file=sys.stderr)
+
+    start = time.perf_counter()
+    summary = run_match(engine1, engine2, args.games, args.workers, args.seed, args.max_moves,
+                        args.elo0, args.elo1, args.alpha, args.beta, progress)
+    summary["seconds"] = round(time.perf_counter() - start, 1)
+    print(file=sys.stderr)
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        json.dump(summary, out, indent=2)
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/local/bin/python3
+
+"""
+Offline tuning of the weights of Gobblet's parameterized evaluation (see
+Gobblet.set_weights and Gobblet.eval_features) from the outcomes of games.
+
+Every position of the games in one or more game record files (see records.py)
+is labeled with the final result for the player who had just moved: 1 for a
+win, 0 for a loss and 0.5 for a draw or an undecided game. The weights are
+fitted so that the evaluation, through a logistic curve, predicts those
+results as closely as possible:
+
+  predicted = 1 / (1 + exp(-score / scale))
+
+minimizing the mean squared error over all the positions, plus a small
+penalty on the size of the weights. The features of the whole dataset are
+worked out at once with Gobblet.feature_batch, and each step of the
+optimization (Adam on the full batch) is a few NumPy matrix products, so
+millions of positions can be fitted in minutes. Finished positions, which the
+evaluation scores as wins or losses whatever the weights, are left out.
+
+Every --holdout'th game is kept out of the fit, and the error on those games
+is reported too, as a check that the weights generalize. The weights are
+rounded to integers and written as JSON, with the noise to add to each score
+so that games between the same players vary:
+
+  { "variant": [4, 4, 3], "positions": 512340, "train_loss": 0.1734,
+    "holdout_loss": 0.1751, "weights": { "own_line_1": 412, ..., "noise": 1000 } }
+
+Usage:
+
+  ./selfplay.py --games 20000 --think-ms 50 --records games.bin
+  ./tune.py games.bin --output weights.json
+  ./selfplay.py --games 1000 --think-ms 50 --weights weights.json
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy
+
+from gobblet import Gobblet
+from records import RecordReader, replay_game
+
+def load_positions(paths, skip_plies=0, max_positions=None):
+    # Replay the games of the record files 'paths', which must all be of one
+    # variant, and return a Gobblet of that variant, the bitboards of every
+    # position reached (in the layout of Gobblet.encode_children, with the
+    # player who had just moved as player 1), the result of each position
+    # for that player and the number of the game it came from
+    gobblet = None
+    rows = []
+    labels = []
+    games = []
+    game_number = 0
+    for path in paths:
+        reader = RecordReader(path)
+        try:
+            variant = (reader.board_size, reader.num_sizes, reader.num_stacks)
+            if gobblet is None:
+                gobblet = Gobblet(tt_mb=0, board_size=variant[0], num_sizes=variant[1],
+                                  num_stacks=variant[2])
+            elif variant != (gobblet.board_size, gobblet.num_sizes, gobblet.num_stacks):
+                raise ValueError(f"{path} is not of the same variant as the files before it")
+            for game in reader.games():
+                winner = game["winner"]
+                for ply, (player, _, _) in enumerate(replay_game(gobblet, game)):
+                    if ply < skip_plies:
+                        continue
+                    rows.append(gobblet.pieces[player - 1] + gobblet.pieces[2 - player])
+                    labels.append(0.5 if not winner else 1.0 if winner == player else 0.0)
+                    games.append(game_number)
+                game_number += 1
+                if max_positions and len(rows) >= max_positions:
+                    break
+        finally:
+            reader.close()
+        if max_positions and len(rows) >= max_positions:
+            break
+    if gobblet is None:
+        raise ValueError("no game record files given")
+    encoded = numpy.array(rows, dtype=numpy.uint64).reshape(len(rows), 2 * gobblet.num_sizes)
+    return gobblet, encoded, numpy.array(labels), numpy.array(games, dtype=numpy.int64)
+
+def loss(features, labels, theta):
+    # Mean squared error of the predicted results
+    predicted = 1 / (1 + numpy.exp(-(features @ theta)))
+    return float(numpy.mean((predicted - labels) ** 2))
+
+def fit(features, labels, iterations=2000, rate=0.01, l2=1e-4):
+    # Fit the weights, in units of the logistic scale, by full-batch Adam
+    # and return them
+    count, num_features = features.shape
+    theta = numpy.zeros(num_features)
+    first = numpy.zeros(num_features)
+    second = numpy.zeros(num_features)
+    beta1, beta2 = 0.9, 0.999
+    for step in range(1, iterations + 1):
+        predicted = 1 / (1 + numpy.exp(-(features @ theta)))
+        # Gradient of the mean squared error through the logistic curve
+        error = 2 * (predicted - labels) * predicted * (1 - predicted)
+        gradient = features.T @ error / count + 2 * l2 * theta
+        first = beta1 * first + (1 - beta1) * gradient
+        second = beta2 * second + (1 - beta2) * gradient ** 2
+        theta -= (rate * (first / (1 - beta1 ** step))
+                  / (numpy.sqrt(second / (1 - beta2 ** step)) + 1e-8))
+    return theta
+
+def tune(paths, skip_plies=0, max_positions=None, holdout=10, iterations=2000, rate=0.01,
+         l2=1e-4, scale=None, noise=1000):
+    # Fit the weights to the games of 'paths' and return the dict written
+    # by main
+    gobblet, encoded, labels, games = load_positions(paths, skip_plies, max_positions)
+    scale = scale or gobblet.big_score
+    features, results = gobblet.feature_batch(1, encoded)
+    unfinished = results == 0
+    features = features[unfinished].astype(numpy.float64)
+    labels = labels[unfinished]
+    games = games[unfinished]
+    if not len(labels):
+        raise ValueError("no unfinished positions to fit")
+    held_out = games % holdout == 0 if holdout else numpy.zeros(len(labels), dtype=bool)
+    training = ~held_out
+
+    theta = fit(features[training], labels[training], iterations, rate, l2)
+    weights = { name: int(round(weight * scale))
+                for name, weight in zip(gobblet.geo.feature_names, theta) }
+    weights["noise"] = noise
+    # The losses of the rounded weights, as they will be used
+    rounded = numpy.array([ weights[name] for name in gobblet.geo.feature_names ]) / scale
+    return {
+        "variant": [ gobblet.board_size, gobblet.num_sizes, gobblet.num_stacks ],
+        "positions": int(training.sum()),
+        "holdout_positions": int(held_out.sum()),
+        "baseline_loss": loss(features[training], labels[training], rounded * 0),
+        "train_loss": loss(features[training], labels[training], rounded),
+        "holdout_loss": loss(features[held_out], labels[held_out], rounded) if held_out.any() else None,
+        "weights": weights,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the Gobblet evaluation weights on games")
+    parser.add_argument("records", nargs="+", help="game record files (see records.py)")
+    parser.add_argument("--output", default=None,
+                        help="file to write the JSON weights to (default: stdout)")
+    parser.add_argument("--skip-plies", type=int, default=0,
+                        help="leave out the first positions of each game")
+    parser.add_argument("--max-positions", type=int, default=None,
+                        help="stop reading games after this many positions")
+    parser.add_argument("--holdout", type=int, default=10,
+                        help="keep every Nth game out of the fit to check the weights on "
+                             "(0 for none)")
+    parser.add_argument("--iterations", type=int, default=2000, help="optimization steps")
+    parser.add_argument("--rate", type=float, default=0.01, help="learning rate")
+    parser.add_argument("--l2", type=float, default=1e-4, help="penalty on the size of the weights")
+    parser.add_argument("--scale", type=int, default=None,
+                        help="score of a 73%% expected result (default: Gobblet.big_score)")
+    parser.add_argument("--noise", type=int, default=1000,
+                        help="random amount below this added to each score when playing")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    result = tune(args.records, args.skip_plies, args.max_positions, args.holdout,
+                  args.iterations, args.rate, args.l2, args.scale, args.noise)
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        json.dump(result, out, indent=2)
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"fitted {result['positions']} positions in {time.perf_counter() - start:.1f}s, "
+          f"loss {result['baseline_loss']:.4f} -> {result['train_loss']:.4f}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()